@@ -5,7 +5,9 @@ from collections import defaultdict
 import argparse
 
 from bottle import template, route, run, request, static_file
-from rebalancer import RebalanceMode, Database, AssetAffinity, Session, AssetTaxGroup
+from rebalancer import RebalanceMode, Database, AssetAffinity, Session, AssetTaxGroup, get_session
+from rebalancer import configure_worker_pool, shutdown_worker_pool, upgrade_database
+from rebalancer import configure_quote_service, QuotePrefetcher, load_quote_snapshot
 
 QUOTE_KEY = None
 
@@ -21,20 +23,22 @@ def send_static(filename):
 def get_token():
     return os.urandom(16).hex()
 
-@route('/rebalance', method='POST')
-def rebalance():
+def render_rebalance(rebalance_modes = None):
     token                  = request.forms.get('user_token')
-    upload                 = request.files.get('upload')
+    uploads                = request.files.getall('upload')
     rebalance_mode_str     = request.forms.get('rebalance_mode')
     show_dollar_values_str = request.forms.get('show_dollar_values')
     fractional_shares_str  = request.forms.get('trade_fractional_shares')
 
-    if upload is None:
+    if len(uploads) == 0:
         return "Must provide a portfolio csv file"
 
-    name, ext = os.path.splitext(upload.filename)
-    if ext not in ['.csv']:
-        return 'File extension not allowed.'
+    for upload in uploads:
+        name, ext = os.path.splitext(upload.filename)
+        if ext not in ['.csv']:
+            return 'File extension not allowed.'
+
+    upload_files = [upload.file for upload in uploads]
 
     taxable_credit = None
     try:
@@ -61,37 +65,57 @@ def rebalance():
             database.add_user(token)
             database.commit()
 
-            session = Session(token, database, upload.file)
+            session = Session(token, database, upload_files)
             return template('www/templates/config.tmpl',
                             user_token = token,
                             session = session,
                             database = database)
 
-        else:
-            session = Session(token,
+        session = get_session(token,
                               database,
-                              upload.file,
+                              upload_files,
                               taxable_credit,
                               tax_deferred_credit,
                               QUOTE_KEY,
                               fractional_shares)
+
+        if rebalance_modes is None:
             return template('www/templates/rebalance.tmpl',
                             user_token = token,
                             session = session,
                             show_dollar_values = show_dollar_values,
                             rebalance_mode = rebalance_mode)
+        else:
+            return template('www/templates/compare.tmpl',
+                            user_token = token,
+                            session = session,
+                            show_dollar_values = show_dollar_values,
+                            rebalance_modes = rebalance_modes)
+
+@route('/rebalance', method='POST')
+def rebalance():
+    return render_rebalance()
+
+@route('/compare', method='POST')
+def compare():
+    rebalance_modes = [RebalanceMode.SELL_ALL,
+                       RebalanceMode.NO_SELL_TAXABLE,
+                       RebalanceMode.NO_SELL,
+                       RebalanceMode.RESHUFFLE]
+    return render_rebalance(rebalance_modes)
 
 @route('/configure', method='POST')
 def configure_show():
     user_token = request.forms.get('user_token')
-    upload     = request.files.get('upload')
+    uploads    = request.files.getall('upload')
 
-    if upload is None:
+    if len(uploads) == 0:
         return "Must provide a portfolio csv file"
 
-    name, ext = os.path.splitext(upload.filename)
-    if ext not in ('.csv'):
-        return 'File extension not allowed.'
+    for upload in uploads:
+        name, ext = os.path.splitext(upload.filename)
+        if ext not in ['.csv']:
+            return 'File extension not allowed.'
 
     with Database() as database:
         salt = database.get_user_salt(user_token)
@@ -99,7 +123,7 @@ def configure_show():
             database.add_user(user_token)
             database.commit()
 
-        session = Session(user_token, database, upload.file)
+        session = Session(user_token, database, [upload.file for upload in uploads])
 
         return template('www/templates/config.tmpl',
                         user_token = user_token,
@@ -274,6 +298,13 @@ def security_configure_update():
         return template('www/templates/security_config.tmpl', database = database)
 
 
+def positive_float(value):
+    ret = float(value)
+    if not ret > 0:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % (value))
+
+    return ret
+
 def main():
     parser = argparse.ArgumentParser(description='Rebalance server')
     parser.add_argument('--bind', dest='host', type=str, default='127.0.0.1',
@@ -284,13 +315,46 @@ def main():
                         help='Enable debug mode in HTTP server')
     parser.add_argument('--quote-key', dest='quote_key', type=str, default=None,
                         help='Alphavantage API key for real-time quote data')
+    parser.add_argument('--quote-url', dest='quote_url', type=str,
+                        default='https://www.alphavantage.co/query',
+                        help='URL of the Alphavantage compatible quote service')
+    parser.add_argument('--quote-fetches', dest='quote_fetches', type=int, default=4,
+                        help='Number of quotes to request at once')
+    parser.add_argument('--quote-snapshot', dest='quote_snapshot', type=str, default=None,
+                        help='CSV file of Symbol,Price quotes to use instead of live quotes')
+    parser.add_argument('--prefetch-quotes', dest='prefetch_quotes', action='store_true',
+                        help='Refresh quotes in the background before they go stale (requires --quote-key)')
+    parser.add_argument('--quote-rate-limit', dest='quote_rate_limit', type=positive_float, default=5,
+                        help='Most quote requests per minute made by the background refresh')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='Number of worker processes (defaults to the number of CPUs)')
+    parser.add_argument('--inline-threshold', dest='inline_threshold', type=int, default=2,
+                        help='Run work lists shorter than this without the worker processes')
 
     args = parser.parse_args()
 
     global QUOTE_KEY
     QUOTE_KEY = args.quote_key
 
-    run(host=args.host, port=args.port, debug=args.debug)
+    upgrade_database()
+    configure_quote_service(args.quote_url, args.quote_fetches)
+    configure_worker_pool(args.workers, args.inline_threshold)
+
+    if args.quote_snapshot is not None:
+        load_quote_snapshot(args.quote_snapshot)
+
+    prefetcher = None
+    if args.prefetch_quotes and QUOTE_KEY is not None:
+        prefetcher = QuotePrefetcher(QUOTE_KEY, args.quote_rate_limit)
+        prefetcher.start()
+
+    try:
+        run(host=args.host, port=args.port, debug=args.debug)
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop()
+
+        shutdown_worker_pool()
 
 if __name__ == "__main__":
     main()
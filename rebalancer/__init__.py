@@ -3,7 +3,7 @@ from .utils import round_cents
 from .utils import compute_percent_difference
 from .utils import get_token_from_file
 
-from .rebalance import RebalanceMode
+from .rebalance import RebalanceMode, RebalanceResult
 
 from .portfolio import Transaction
 
@@ -14,11 +14,18 @@ from .crypto import encrypt_account_description
 from .crypto import decrypt_account_description
 
 from .parser import parse_file
+from .parser import iter_file
+from .parser import register_format, ColumnFormat
 
-from .db import Database, AssetAffinity, AssetTaxGroup
+from .db import Database, AssetAffinity, AssetTaxGroup, upgrade_database
 
-from .session import Session
+from .session import Session, get_session
 
-from .securities import SecurityDatabase
+from .securities import SecurityDatabase, QuotePrefetcher
+
+from .quotes import configure_quote_service
+from .quotes import load_quote_snapshot, save_quote_snapshot
 
 from .target import AccountTarget
+
+from .workers import configure_worker_pool, shutdown_worker_pool
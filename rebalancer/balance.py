@@ -1,10 +1,22 @@
-from decimal import Decimal
 from collections import defaultdict
 from functools import partial, cmp_to_key
-from itertools import chain, product
-from math import floor
+from itertools import chain, product, islice
+from math import floor, ceil, prod
+from operator import itemgetter
 
-from .utils import round_cents
+from .utils import round_cents, ZERO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+REMAINDER_SHARE_WINDOW = 3
+# Largest number of price units the knapsack solver will track before falling
+# back to the exhaustive search
+MAX_KNAPSACK_UNITS = 1 << 26
+# Number of transactions priced at once by the exhaustive search
+REMAINDER_SEARCH_CHUNK_SIZE = 1 << 14
 
 def compute_asset_differences(actual_assets, target_assets):
     all_asset_names = frozenset(chain(actual_assets.keys(),
@@ -12,53 +24,191 @@ def compute_asset_differences(actual_assets, target_assets):
 
     asset_differences = {}
     for asset in all_asset_names:
-        actual_value = actual_assets.get(asset, Decimal(0.0))
-        target_value = target_assets.get(asset, Decimal(0.0))
+        actual_value = actual_assets.get(asset, ZERO)
+        target_value = target_assets.get(asset, ZERO)
 
         asset_differences[asset] = actual_value - target_value
 
     return asset_differences
 
-def compute_transaction_price(transaction):
-    transaction_price = Decimal(0.0)
-    for (symbol, (shares, buy_price)) in transaction:
-        sale_value = shares * buy_price
-        transaction_price = transaction_price + sale_value
+def get_price_scale(prices):
+    places = 0
+    for price in prices:
+        places = max(places, -price.normalize().as_tuple().exponent)
+
+    return 10 ** places
+
+def get_price_units(rebalance_items, available_funds):
+    # Convert share prices to integer units of the smallest price increment
+    # so candidate transactions can be priced without Decimal arithmetic
+    prices = [items[0][1][1] for items in rebalance_items]
+    scale = get_price_scale(prices)
+    unit_prices = [int(price * scale) for price in prices]
+
+    # Transactions must cost strictly less than the available funds
+    max_units = ceil(available_funds * scale) - 1
+
+    return (unit_prices, max_units)
+
+def compute_vectorized_remainder_purchase(rebalance_items, unit_costs, max_units):
+    sizes = [len(costs) for costs in unit_costs]
+    cost_arrays = [numpy.array(costs, dtype=numpy.int64) for costs in unit_costs]
+    num_transactions = prod(sizes)
+
+    best_transaction_idx = -1
+    best_transaction_units = 0
+    # Each transaction is identified by its index in the order product would
+    # generate it. A block of indices is split into the share offset for each
+    # position, and the transaction totals are summed for the whole block
+    for start in range(0, num_transactions, REMAINDER_SEARCH_CHUNK_SIZE):
+        stop = min(start + REMAINDER_SEARCH_CHUNK_SIZE, num_transactions)
+        remaining = numpy.arange(start, stop, dtype=numpy.int64)
+        transaction_units = numpy.zeros(stop - start, dtype=numpy.int64)
+        for (size, costs) in zip(reversed(sizes), reversed(cost_arrays)):
+            transaction_units += costs[remaining % size]
+            remaining //= size
+
+        transaction_units[transaction_units > max_units] = -1
+        # argmax returns the first of any equal totals, just like the
+        # sequential search
+        block_idx = int(transaction_units.argmax())
+        block_units = int(transaction_units[block_idx])
+        if block_units > best_transaction_units:
+            best_transaction_idx = start + block_idx
+            best_transaction_units = block_units
+
+        if best_transaction_units == max_units:
+            break
+
+    if best_transaction_idx < 0:
+        return {}
+
+    best_transaction = []
+    for items in reversed(rebalance_items):
+        best_transaction.append(items[best_transaction_idx % len(items)])
+        best_transaction_idx //= len(items)
+    best_transaction.reverse()
+
+    return dict(filter(lambda x: x[1][0] > 0, best_transaction))
 
-    return transaction_price
+def compute_exhaustive_remainder_purchase(rebalance_items, available_funds):
+    (unit_prices, max_units) = get_price_units(rebalance_items, available_funds)
+    if max_units <= 0:
+        return {}
 
-def compute_minimal_remainder_purchase(rebalance, available_funds, max_values):
+    unit_costs = [[shares * unit_price for (_, (shares, _)) in items]
+                  for (items, unit_price) in zip(rebalance_items, unit_prices)]
+
+    # Transaction indices and totals must both fit in a 64-bit integer
+    max_vectorized_value = 1 << 62
+    if numpy is not None and \
+       prod(map(len, unit_costs)) < max_vectorized_value and \
+       sum(map(max, unit_costs)) < max_vectorized_value:
+        return compute_vectorized_remainder_purchase(rebalance_items,
+                                                     unit_costs,
+                                                     max_units)
+
+    best_transaction = None
+    best_transaction_units = 0
+    # Iterate through all the potential transactions and find the one which
+    # most fully utilizes the available funds. The product function will
+    # lazily generate all possible transactions from the items we
+    # constructed for each position, which are priced a chunk at a time so
+    # only the best transaction so far is kept. No transaction can do better
+    # than max_units, so stop searching once one is found
+    transactions_to_try = zip(product(*rebalance_items), product(*unit_costs))
+    while best_transaction_units != max_units:
+        chunk = list(islice(transactions_to_try, REMAINDER_SEARCH_CHUNK_SIZE))
+        if len(chunk) == 0:
+            break
+
+        transaction_units = map(sum, map(itemgetter(1), chunk))
+        for ((transaction, _), units) in zip(chunk, transaction_units):
+            if units <= max_units and units > best_transaction_units:
+               best_transaction = transaction
+               best_transaction_units = units
+
+    if best_transaction is None:
+        return {}
+    else:
+        return dict(filter(lambda x: x[1][0] > 0, best_transaction))
+
+def compute_knapsack_remainder_purchase(rebalance_items, available_funds):
+    if len(rebalance_items) == 0:
+        return {}
+
+    # Each position contributes its minimum share count to a fixed base
+    # cost, and the solver only tracks the offset above that base
+    (unit_prices, max_units) = get_price_units(rebalance_items, available_funds)
+    min_shares = [items[0][1][0] for items in rebalance_items]
+
+    base = sum(map(lambda x: x[0] * x[1], zip(min_shares, unit_prices)))
+    capacity = max_units - base
+    if capacity < 0:
+        return {}
+
+    span = sum(map(lambda x: (len(x[0]) - 1) * x[1],
+                   zip(rebalance_items, unit_prices)))
+    capacity = min(capacity, span)
+    if capacity > MAX_KNAPSACK_UNITS:
+        return None
+
+    # reachable[i] is a bitset of the offsets which can be reached using
+    # positions i and later
+    full_mask = (1 << (capacity + 1)) - 1
+    reachable = [1]
+    for (items, unit_price) in zip(reversed(rebalance_items), reversed(unit_prices)):
+        prev = reachable[-1]
+        cur = 0
+        for offset in range(0, len(items)):
+            cur |= prev << (offset * unit_price)
+
+        reachable.append(cur & full_mask)
+    reachable.reverse()
+
+    candidates = reachable[0]
+    if base == 0:
+        # An empty transaction is never a valid purchase
+        candidates &= ~1
+
+    if candidates == 0:
+        return {}
+
+    # Pick the lowest share count for each position which can still reach
+    # the best total. This matches the first transaction the exhaustive
+    # search would have found
+    remaining = candidates.bit_length() - 1
+    best_transaction = []
+    for (idx, (items, unit_price)) in enumerate(zip(rebalance_items, unit_prices)):
+        for (offset, item) in enumerate(items):
+            rest = remaining - offset * unit_price
+            if rest >= 0 and (reachable[idx + 1] >> rest) & 1:
+                best_transaction.append(item)
+                remaining = rest
+                break
+
+    return dict(filter(lambda x: x[1][0] > 0, best_transaction))
+
+def compute_minimal_remainder_purchase(rebalance,
+                                       available_funds,
+                                       max_values,
+                                       delta = REMAINDER_SHARE_WINDOW):
     rebalance_items = []
-    # Construct transactions for each position selling one less share, one
-    # more share, and the nominal number of shares
+    # Construct transactions for each position selling up to delta fewer
+    # shares, up to delta more shares, and the nominal number of shares
     for (symbol, (shares, sell_price)) in rebalance.items():
-        delta = 3
         min_shares = int(max(0, shares - delta))
         max_shares = int(shares + delta + 1)
         cur = [(symbol, (x, sell_price)) for x in range(min_shares, max_shares)]
 
         rebalance_items.append(cur)
 
-    best_transaction_idx = -1
-    best_transaction_price = Decimal(0.0)
-    # Iterate through all the potential transactions and find the one which
-    # most fully utilizes the available funds. The product function will
-    # generate a list of all possible transactions from the items we
-    # constructed for each position above
-    from multiprocessing import Pool
-    with Pool() as p:
-        transactions_to_try = list(product(*rebalance_items))
-        transaction_prices = list(p.map(compute_transaction_price, transactions_to_try))
-        for idx in range(0, len(transaction_prices)):
-            transaction_price = transaction_prices[idx]
-
-            if transaction_price < available_funds and transaction_price > best_transaction_price:
-               best_transaction_idx = idx
-               best_transaction_price = transaction_price
-
-        if best_transaction_idx < 0:
-            return {}
-        else:
-            best_transaction = filter(lambda x: x[1][0] > 0,
-                                      transactions_to_try[best_transaction_idx])
-            return dict(best_transaction)
+    best_transaction = compute_knapsack_remainder_purchase(rebalance_items,
+                                                           available_funds)
+    if best_transaction is None:
+        # Prices with many decimal places can make the solver too large,
+        # so fall back to trying every transaction
+        best_transaction = compute_exhaustive_remainder_purchase(rebalance_items,
+                                                                 available_funds)
+
+    return best_transaction
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class TTLCache:
+    def __init__(self, max_size, ttl = None):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def __expired(self, expires):
+        return expires is not None and expires <= monotonic()
+
+    def __lookup(self, key, default):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return default
+
+        (value, expires) = entry
+        if self.__expired(expires):
+            del self.__entries[key]
+            return default
+
+        self.__entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        sentinel = object()
+        with self.__lock:
+            value = self.__lookup(key, sentinel)
+            if value is sentinel:
+                self.__misses += 1
+                return default
+            else:
+                self.__hits += 1
+                return value
+
+    def __contains__(self, key):
+        sentinel = object()
+        with self.__lock:
+            return self.__lookup(key, sentinel) is not sentinel
+
+    def put(self, key, value, ttl = None):
+        ttl = self.__ttl if ttl is None else ttl
+        expires = None if ttl is None else monotonic() + ttl
+
+        with self.__lock:
+            self.__entries[key] = (value, expires)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def discard_if(self, predicate):
+        with self.__lock:
+            for key in list(filter(predicate, self.__entries.keys())):
+                del self.__entries[key]
+
+    def keys(self):
+        with self.__lock:
+            return [key for (key, (_, expires)) in self.__entries.items()
+                    if not self.__expired(expires)]
+
+    def items(self):
+        with self.__lock:
+            return [(key, value) for (key, (value, expires)) in self.__entries.items()
+                    if not self.__expired(expires)]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def hits(self):
+        return self.__hits
+
+    def misses(self):
+        return self.__misses
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
@@ -9,6 +9,7 @@ except ImportError:
 
 from .pyaes import AESModeOfOperationCTR
 from .utils import get_salt_from_file
+from .workers import parallel_map
 
 def hash_user_token(user_token):
     salt = get_salt_from_file()
@@ -58,22 +59,20 @@ def parallel_get_account_hashes_and_keys(user_token,
                                          salt,
                                          account_hashes_to_get,
                                          account_keys_to_get):
-    from multiprocessing import Pool
-    with Pool() as p:
-        account_hashes = {}
-        account_keys = {}
+    account_hashes = {}
+    account_keys = {}
 
-        hashes = list(p.map(partial(hash_account_name, user_token, salt),
-                            account_hashes_to_get))
-        keys = list(p.map(partial(get_description_key, user_token, salt),
-                          account_keys_to_get))
+    hashes = parallel_map(partial(hash_account_name, user_token, salt),
+                          account_hashes_to_get)
+    keys = parallel_map(partial(get_description_key, user_token, salt),
+                        account_keys_to_get)
 
-        for (account, account_hash) in zip(account_hashes_to_get, hashes):
-            key = (user_token, account)
-            account_hashes[key] = account_hash
+    for (account, account_hash) in zip(account_hashes_to_get, hashes):
+        key = (user_token, account)
+        account_hashes[key] = account_hash
 
-        for (account, account_key) in zip(account_keys_to_get, keys):
-            key = (user_token, account)
-            account_keys[key] = account_key
+    for (account, account_key) in zip(account_keys_to_get, keys):
+        key = (user_token, account)
+        account_keys[key] = account_key
 
-        return (account_hashes, account_keys)
+    return (account_hashes, account_keys)
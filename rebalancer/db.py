@@ -3,6 +3,7 @@ from sqlite3 import connect
 from decimal import Decimal
 from collections import namedtuple
 from functools import partial
+from threading import Lock, local
 
 from .crypto import hash_user_token, hash_account_name, hash_user_token_with_salt
 from .crypto import encrypt_account_description,\
@@ -10,6 +11,8 @@ from .crypto import encrypt_account_description,\
                     get_description_key,        \
                     parallel_get_account_hashes_and_keys
 from .utils import round_cents
+from .cache import TTLCache
+from .workers import parallel_map
 
 AssetTarget = namedtuple('AssetTarget', 'asset target target_type')
 AssetTaxGroup = namedtuple('AssetTaxGroup', 'asset tax_group')
@@ -31,12 +34,135 @@ DB_UPGRADE_FILENAMES = [
 
 CURRENT_DB_VERSION = 1
 
+# Older SQLite builds allow at most 999 parameters in a statement
+MAX_QUERY_PARAMETERS = 500
+
+# PBKDF2 derived hashes and keys are expensive to compute, so they are shared
+# by every Database instance in the process. They are only kept in memory
+DERIVED_KEY_CACHE_SIZE = 4096
+DERIVED_KEY_CACHE_TTL = 60 * 60
+
+derived_key_cache = TTLCache(DERIVED_KEY_CACHE_SIZE, DERIVED_KEY_CACHE_TTL)
+
+def clear_derived_keys(user_token):
+    derived_key_cache.discard_if(lambda key: key[1] == user_token)
+
+# Incremented whenever securities, assets, or asset groups change so cached
+# copies of them know to reload
+_reference_data_version = 0
+_reference_data_version_lock = Lock()
+
+def get_reference_data_version():
+    return _reference_data_version
+
+def bump_reference_data_version():
+    global _reference_data_version
+
+    with _reference_data_version_lock:
+        _reference_data_version += 1
+
+# Incremented whenever a user's accounts, targets, or affinities change so
+# cached sessions know to reload
+_user_config_versions = {}
+_user_config_versions_lock = Lock()
+
+def get_user_config_version(user_token):
+    return _user_config_versions.get(user_token, 0)
+
+def bump_user_config_version(user_token):
+    with _user_config_versions_lock:
+        _user_config_versions[user_token] = get_user_config_version(user_token) + 1
+
+# Connection settings applied once when a pooled connection is opened
+DB_CACHE_SIZE_KB = 16 * 1024
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+def get_database_path():
+    this_file_path = path.abspath(__file__)
+    this_dir = path.dirname(this_file_path)
+
+    return path.join(this_dir, "rebalance.db")
+
 def create_db_conn(database_path):
     conn = connect(database_path)
     conn.execute("PRAGMA foreign_keys = ON;")
 
     return conn
 
+def configure_db_conn(conn):
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA cache_size = -%d;" % (DB_CACHE_SIZE_KB))
+    conn.execute("PRAGMA mmap_size = %d;" % (DB_MMAP_SIZE))
+
+def run_upgrade_scripts(conn):
+    this_dir = path.dirname(path.abspath(__file__))
+
+    db_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    while db_version < len(DB_UPGRADE_FILENAMES):
+        script_path = path.join(this_dir, DB_UPGRADE_FILENAMES[db_version])
+        with open(script_path, "r") as f:
+            conn.executescript(f.read())
+            conn.commit()
+
+        db_version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+class ConnectionPool:
+    def __init__(self, database_path):
+        self.__database_path = database_path
+        self.__local = local()
+        self.__lock = Lock()
+        self.__upgraded = False
+
+    def upgrade(self):
+        with self.__lock:
+            if not self.__upgraded:
+                conn = create_db_conn(self.__database_path)
+                try:
+                    run_upgrade_scripts(conn)
+                finally:
+                    conn.close()
+
+                self.__upgraded = True
+
+    def acquire(self):
+        if not self.__upgraded:
+            self.upgrade()
+
+        # Each thread gets its own connection, which is shared by every
+        # Database opened on that thread
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = create_db_conn(self.__database_path)
+            configure_db_conn(conn)
+
+            self.__local.conn = conn
+            self.__local.borrowers = 0
+
+        self.__local.borrowers += 1
+        return conn
+
+    def release(self):
+        self.__local.borrowers -= 1
+        if self.__local.borrowers == 0:
+            # Discard anything which was not committed, just like closing
+            # the connection would have
+            self.__local.conn.rollback()
+
+_connection_pool = None
+_connection_pool_lock = Lock()
+
+def get_connection_pool():
+    global _connection_pool
+
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool(get_database_path())
+
+        return _connection_pool
+
+def upgrade_database():
+    get_connection_pool().upgrade()
+
 def decrypt_account_info(val):
     (encrypted_info, description_key) = val
     if encrypted_info is not None:
@@ -51,41 +177,23 @@ def decrypt_account_info(val):
         return None
 
 def decrypt_account_infos(encrypted_infos, account_keys):
-    worklist = list(zip(encrypted_infos, account_keys))
+    worklist = zip(encrypted_infos, account_keys)
 
-    from multiprocessing import Pool
-    with Pool() as p:
-        return list(p.map(decrypt_account_info, worklist))
+    return parallel_map(decrypt_account_info, worklist)
 
 class Database:
     def __init__(self):
-        this_file_path = path.abspath(__file__)
-        this_dir = path.dirname(this_file_path)
-        database_path = path.join(this_dir, "rebalance.db")
+        self.__pool = get_connection_pool()
+        self.__conn = self.__pool.acquire()
 
-        self.__conn = create_db_conn(database_path)
-
-        db_version = self.get_db_version()
-        while db_version < len(DB_UPGRADE_FILENAMES):
-            script_path = path.join(this_dir, DB_UPGRADE_FILENAMES[db_version])
-            with open(script_path, "r") as f:
-                self.__conn.executescript(f.read())
-                self.__conn.commit()
-
-            db_version = self.get_db_version()
-
-        self.__hashed_tokens_system = {}
-        self.__hashed_tokens_user = {}
-        self.__account_hashes = {}
-        self.__account_keys = {}
-
-        self.__hashed_tokens_user["DEFAULT"] = "DEFAULT"
+        self.__has_reference_changes = False
+        self.__user_config_changes = set()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self.__conn.close()
+        self.__pool.release()
 
     def __return_iter(self, result_type, cmd, *args):
         cur = self.__conn.execute(cmd, args)
@@ -99,44 +207,53 @@ class Database:
         return None if row is None else result_type(row)
 
     def __get_user_hash_system_salt(self, user_token):
-        if user_token not in self.__hashed_tokens_system:
+        key = ("system", user_token)
+        hashed_token = derived_key_cache.get(key)
+        if hashed_token is None:
             hashed_token = hash_user_token(user_token)
-            self.__hashed_tokens_system[user_token] = hashed_token
+            derived_key_cache.put(key, hashed_token)
 
-        return self.__hashed_tokens_system[user_token]
+        return hashed_token
 
     def __get_user_hash_user_salt(self, user_token):
-        if user_token not in self.__hashed_tokens_user:
+        if user_token == "DEFAULT":
+            return "DEFAULT"
+
+        key = ("user", user_token)
+        salted_token = derived_key_cache.get(key)
+        if salted_token is None:
             salt = self.get_user_salt(user_token)
             salted_token = hash_user_token_with_salt(user_token, salt)
-            self.__hashed_tokens_user[user_token] = salted_token
+            derived_key_cache.put(key, salted_token)
 
-        return self.__hashed_tokens_user[user_token]
+        return salted_token
 
     def __get_account_hash(self, user_token, account):
-        key = (user_token, account)
-        if key not in self.__account_hashes:
+        key = ("hash", user_token, account)
+        account_hash = derived_key_cache.get(key)
+        if account_hash is None:
             salt = self.get_user_salt(user_token)
             account_hash = hash_account_name(user_token, salt, account)
 
-            self.__account_hashes[key] = account_hash
+            derived_key_cache.put(key, account_hash)
 
-        return self.__account_hashes[key]
+        return account_hash
 
     def __get_account_key(self, user_token, account):
-        key = (user_token, account)
-        if key not in self.__account_keys:
+        key = ("key", user_token, account)
+        description_key = derived_key_cache.get(key)
+        if description_key is None:
             salt = self.get_user_salt(user_token)
             description_key = get_description_key(user_token, salt, account)
 
-            self.__account_keys[key] = description_key
+            derived_key_cache.put(key, description_key)
 
-        return self.__account_keys[key]
+        return description_key
 
     def __preseed_account_entries(self, user_token, accounts):
-        account_hashes_to_get = list(filter(lambda x: (user_token, x) not in self.__account_hashes,
+        account_hashes_to_get = list(filter(lambda x: ("hash", user_token, x) not in derived_key_cache,
                                             accounts))
-        account_keys_to_get = list(filter(lambda x: (user_token, x) not in self.__account_keys,
+        account_keys_to_get = list(filter(lambda x: ("key", user_token, x) not in derived_key_cache,
                                           accounts))
         if len(account_hashes_to_get) > 0 or len(account_keys_to_get) > 0:
             salt = self.get_user_salt(user_token)
@@ -147,8 +264,23 @@ class Database:
                                                      account_hashes_to_get,
                                                      account_keys_to_get)
 
-            self.__account_hashes.update(account_hashes)
-            self.__account_keys.update(account_keys)
+            for ((_, account), account_hash) in account_hashes.items():
+                derived_key_cache.put(("hash", user_token, account), account_hash)
+
+            for ((_, account), account_key) in account_keys.items():
+                derived_key_cache.put(("key", user_token, account), account_key)
+
+    def __replace_user_rows(self, user_hash, rows, select_cmd, insert_cmd, delete_cmd):
+        # Nothing to do if the user's rows already match
+        current_rows = list(self.__return_iter(tuple, select_cmd, user_hash))
+        if sorted(current_rows) == sorted(rows):
+            return
+
+        # Both statements run in the caller's transaction, so nothing is kept
+        # unless the caller commits
+        self.__conn.execute(delete_cmd, (user_hash,))
+        self.__conn.executemany(insert_cmd,
+                                map(lambda x: x + (user_hash,), rows))
 
     def get_db_version(self):
         return self.__return_one(lambda x: x[0], "PRAGMA user_version")
@@ -164,13 +296,18 @@ class Database:
 
     def set_asset_targets(self, user_token, asset_targets):
         user_hash = self.__get_user_hash_user_salt(user_token)
-        self.__return_one(''.join,
-                          "DELETE FROM Targets WHERE User == ?",
-                          user_hash)
 
-        for (asset, target, target_type) in asset_targets:
-            cmd = "INSERT INTO Targets (User, AssetID, Target, TargetType) VALUES (?, (SELECT ID FROM Assets WHERE Abbreviation == ?), ?, (SELECT ID FROM TargetTypes WHERE Name == ?))"
-            self.__return_one(str, cmd, user_hash, asset, target, target_type)
+        asset_ids = dict(self.get_asset_abbreviations())
+        target_type_ids = dict(map(lambda x: (x.name, x.id), self.get_target_types()))
+
+        rows = [(asset_ids[asset], target, target_type_ids[target_type])
+                for (asset, target, target_type) in asset_targets]
+
+        select_cmd = "SELECT AssetID, Target, TargetType FROM Targets WHERE User == ?"
+        insert_cmd = "INSERT INTO Targets (AssetID, Target, TargetType, User) VALUES (?, ?, ?, ?)"
+        delete_cmd = "DELETE FROM Targets WHERE User == ?"
+        self.__replace_user_rows(user_hash, rows, select_cmd, insert_cmd, delete_cmd)
+        self.__user_config_changed(user_token)
 
     def get_asset_tax_affinity(self, user_token):
         user_hash = self.__get_user_hash_user_salt(user_token)
@@ -205,6 +342,7 @@ class Database:
     def set_default_security(self, symbol):
         cmd = "UPDATE Securities SET IsDefault = 1 WHERE Symbol == ?"
         self.__return_one(str, cmd, symbol)
+        self.__reference_data_changed()
 
     def get_tax_groups(self):
         cmd = "SELECT Name, ID FROM TaxGroups"
@@ -222,6 +360,10 @@ class Database:
         cmd = "INSERT INTO UserSalts (User, Salt) VALUES (?, ?)"
         self.__return_one(str, cmd, user_hash, urandom(16).hex())
 
+        # Anything derived from a previous salt is no longer valid
+        clear_derived_keys(user_token)
+        self.__user_config_changed(user_token)
+
     def add_account(self, user_token, account, description, tax_group, is_default):
         hashed_account = self.__get_account_hash(user_token, account)
 
@@ -238,28 +380,39 @@ class Database:
                           encrypted_description,
                           tax_group,
                           is_default)
+        self.__user_config_changed(user_token)
 
     def delete_account(self, user_token, account):
         hashed_account = self.__get_account_hash(user_token, account)
 
-        del self.__account_hashes[(user_token, account)]
+        derived_key_cache.discard(("hash", user_token, account))
 
         cmd = "DELETE FROM Accounts WHERE ID == ?"
         self.__return_one(str, cmd, hashed_account)
+        self.__user_config_changed(user_token)
 
 
     def get_account_infos(self, user_token, accounts):
+        accounts = list(accounts)
         self.__preseed_account_entries(user_token, accounts)
 
         account_keys = map(partial(self.__get_account_key, user_token),
                            accounts)
 
-        hashed_accounts = map(partial(self.__get_account_hash, user_token),
-                              accounts)
+        hashed_accounts = list(map(partial(self.__get_account_hash, user_token),
+                                   accounts))
 
-        cmd = "SELECT Description, TaxGroup, IsDefault FROM AccountInfoMap WHERE AccountID = ?"
-        encrypted_infos = map(partial(self.__return_one, tuple, cmd),
-                              hashed_accounts)
+        # Look up all the accounts at once (in batches small enough for
+        # SQLite's parameter limit) then put the results back in input order
+        rows = {}
+        for start in range(0, len(hashed_accounts), MAX_QUERY_PARAMETERS):
+            batch = hashed_accounts[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ', '.join('?' * len(batch))
+            cmd = "SELECT AccountID, Description, TaxGroup, IsDefault FROM AccountInfoMap WHERE AccountID IN (%s)" % placeholders
+            for row in self.__return_iter(tuple, cmd, *batch):
+                rows[row[0]] = row[1:]
+
+        encrypted_infos = map(rows.get, hashed_accounts)
         return decrypt_account_infos(encrypted_infos, account_keys)
 
     def get_account_info(self, user_token, account):
@@ -282,21 +435,23 @@ class Database:
     def set_asset_affinities(self, user_token, asset_affinities, asset_sales_mask):
         salted_token = self.__get_user_hash_user_salt(user_token)
 
-        self.__return_one(''.join,
-                          "DELETE FROM AssetAffinities WHERE User == ?",
-                          salted_token)
+        asset_ids = dict(self.get_asset_abbreviations())
+        tax_group_ids = dict(self.get_tax_groups())
 
+        rows = []
         for affinity in asset_affinities:
             asset_tax_group = AssetTaxGroup(affinity.asset, affinity.tax_group)
             can_sell = 0 if asset_tax_group in asset_sales_mask else 1
-            cmd = "INSERT INTO AssetAffinities (User, TaxGroupID, AssetID, Priority, CanSell) VALUES (?, (SELECT ID FROM TaxGroups WHERE Name == ?), (SELECT ID FROM Assets WHERE Abbreviation == ?), ?, ?)"
-            self.__return_one(''.join,
-                              cmd,
-                              salted_token,
-                              affinity.tax_group,
-                              affinity.asset,
-                              affinity.priority,
-                              can_sell)
+            rows.append((tax_group_ids[affinity.tax_group],
+                         asset_ids[affinity.asset],
+                         affinity.priority,
+                         can_sell))
+
+        select_cmd = "SELECT TaxGroupID, AssetID, Priority, CanSell FROM AssetAffinities WHERE User == ?"
+        insert_cmd = "INSERT INTO AssetAffinities (TaxGroupID, AssetID, Priority, CanSell, User) VALUES (?, ?, ?, ?, ?)"
+        delete_cmd = "DELETE FROM AssetAffinities WHERE User == ?"
+        self.__replace_user_rows(salted_token, rows, select_cmd, insert_cmd, delete_cmd)
+        self.__user_config_changed(user_token)
 
     def get_asset_sales_mask(self, user_token):
         salted_token = self.__get_user_hash_user_salt(user_token)
@@ -308,26 +463,32 @@ class Database:
     def add_symbol(self, symbol, asset, is_default = False):
         cmd = "INSERT INTO Securities (Symbol, AssetID, IsDefault) VALUES (?, (SELECT ID FROM Assets WHERE Abbreviation == ?), ?)"
         self.__return_one(str, cmd, symbol, asset, is_default)
+        self.__reference_data_changed()
 
     def delete_symbol(self, symbol):
         cmd = "DELETE FROM Securities WHERE Symbol == ?"
         self.__return_one(str, cmd, symbol)
+        self.__reference_data_changed()
 
     def add_asset(self, asset, asset_group):
         cmd = "INSERT INTO Assets (Abbreviation, AssetGroupID) VALUES (?, (SELECT ID FROM AssetGroups WHERE Name == ?))"
         self.__return_one(str, cmd, asset, asset_group)
+        self.__reference_data_changed()
 
     def delete_asset(self, asset):
         cmd = "DELETE FROM Assets WHERE Abbreviation == ?"
         self.__return_one(str, cmd, asset)
+        self.__reference_data_changed()
 
     def add_asset_group(self, asset_group):
         cmd = "INSERT INTO AssetGroups (Name) VALUES (?)"
         self.__return_one(str, cmd, asset_group)
+        self.__reference_data_changed()
 
     def delete_asset_group(self, asset_group):
         cmd = "DELETE FROM AssetGroups WHERE Name == ?"
         self.__return_one(str, cmd, asset_group)
+        self.__reference_data_changed()
 
     def add_quote(self, symbol, price):
         price_cents = int(price * 100)
@@ -339,5 +500,53 @@ class Database:
         cents = self.__return_one(tuple, cmd, symbol)
         return round_cents(Decimal(cents[0]) / 100) if cents is not None else None
 
+    def add_quotes(self, quotes):
+        cmd = "INSERT INTO Quotes (Symbol, QuoteCents) VALUES (?, ?)"
+        self.__conn.executemany(cmd,
+                                map(lambda x: (x[0], int(x[1] * 100)), quotes))
+
+    def get_quotes(self, symbols):
+        symbols = list(dict.fromkeys(symbols))
+
+        # Rows are ordered oldest first so the latest quote for each symbol
+        # is the one left in the result. Each quote is returned with the
+        # time it was taken, in seconds since the epoch
+        quotes = {}
+        for start in range(0, len(symbols), MAX_QUERY_PARAMETERS):
+            batch = symbols[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ', '.join('?' * len(batch))
+            cmd = "SELECT Symbol, QuoteCents, CAST(strftime('%%s', QuoteTime) AS INTEGER) FROM Quotes WHERE Symbol IN (%s) AND ((LENGTH(Symbol) == 5 AND QuoteTime > date('now')) OR (QuoteTime > datetime('now', '-15 minutes'))) ORDER BY QuoteTime ASC" % placeholders
+            for (symbol, cents, quote_time) in self.__return_iter(tuple, cmd, *batch):
+                quotes[symbol] = (round_cents(Decimal(cents) / 100), quote_time)
+
+        return quotes
+
+    def get_latest_quotes(self):
+        # Like get_quotes, but for every symbol regardless of how old its
+        # latest quote is
+        cmd = "SELECT Symbol, QuoteCents FROM Quotes ORDER BY QuoteTime ASC"
+        return dict(map(lambda x: (x[0], round_cents(Decimal(x[1]) / 100)),
+                        self.__return_iter(tuple, cmd)))
+
+    def __reference_data_changed(self):
+        # Bump the version now so this connection sees its own change, and
+        # again on commit so no other connection keeps a snapshot loaded
+        # before the change was visible to it
+        self.__has_reference_changes = True
+        bump_reference_data_version()
+
+    def __user_config_changed(self, user_token):
+        # Same as the reference data, but only for the one user
+        self.__user_config_changes.add(user_token)
+        bump_user_config_version(user_token)
+
     def commit(self):
         self.__conn.commit()
+
+        if self.__has_reference_changes:
+            self.__has_reference_changes = False
+            bump_reference_data_version()
+
+        for user_token in self.__user_config_changes:
+            bump_user_config_version(user_token)
+        self.__user_config_changes.clear()
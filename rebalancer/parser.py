@@ -1,40 +1,204 @@
 from decimal import Decimal
-from csv import DictReader
+from csv import reader
 from collections import namedtuple
-from io import TextIOWrapper
-from itertools import filterfalse
+from io import TextIOWrapper, BytesIO
+from itertools import filterfalse, chain
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from mmap import mmap, ACCESS_READ
+from os import fstat
+from codecs import BOM_UTF8
 
 from .utils import CORE
+from .cache import TTLCache
+
+AccountEntry = namedtuple('AccountEntry',
+                          'account_name symbol share_price current_value description shares')
+
+# Each format lists the names a column may have in that brokerage's export,
+# in order of preference. A format matches a file if its header has at least
+# one name for every column
+ColumnFormat = namedtuple('ColumnFormat',
+                          'name account symbol description current_value quantity last_price ends_at_blank_line')
+
+FIDELITY_FORMAT = ColumnFormat("Fidelity",
+                               ("Account Number", "Account Name/Number"),
+                               ("Symbol",),
+                               ("Description",),
+                               ("Current Value",),
+                               ("Quantity",),
+                               ("Last Price",),
+                               False)
+
+# Vanguard exports list transactions with a different header after the
+# positions, separated by a blank line
+VANGUARD_FORMAT = ColumnFormat("Vanguard",
+                               ("Account Number",),
+                               ("Symbol",),
+                               ("Investment Name",),
+                               ("Total Value",),
+                               ("Shares",),
+                               ("Share Price",),
+                               True)
+
+PORTFOLIO_FORMATS = [FIDELITY_FORMAT, VANGUARD_FORMAT]
+
+FORMAT_COLUMN_FIELDS = ('account',
+                        'symbol',
+                        'description',
+                        'current_value',
+                        'quantity',
+                        'last_price')
+
+# Users often upload the same file several times with different options, so
+# keep the entries for recent uploads keyed by a digest of their contents.
+# The entries are only ever kept in memory
+PARSE_CACHE_SIZE = 32
+
+parse_cache = TTLCache(PARSE_CACHE_SIZE)
+
+MAX_PARSE_THREADS = 8
+
+# Characters which only decorate a number, removed in a single pass
+NUMBER_FORMATTING = str.maketrans('', '', ',$')
+# Cells which some exports use to show there is no value
+MISSING_NUMBERS = frozenset(('', '--'))
+
+def is_missing_number(val):
+    return val is None or val in MISSING_NUMBERS
+
+def clean_number(val):
+    val = val.strip()
+
+    # Some exports show negative values in parentheses
+    if val.startswith('(') and val.endswith(')'):
+        return '-' + val[1:-1].translate(NUMBER_FORMATTING).strip()
+    else:
+        return val.translate(NUMBER_FORMATTING).strip()
 
 def parse_number_column(val, default=None):
-    if default is None:
-        return Decimal(val.replace(',', '').replace('$', ''))
+    if default is not None and is_missing_number(val):
+        return default
     else:
-        return default if val is None or len(val) == 0 else parse_number_column(val)
+        return Decimal(clean_number(val))
+
+def parse_number_units(val, places, default=None):
+    if default is not None and is_missing_number(val):
+        return default
+
+    # Shift the decimal point without going through Decimal, so the result
+    # is an exact integer count of 10^-places units
+    number = clean_number(val)
+    sign = ''
+    if number.startswith(('-', '+')):
+        (sign, number) = (number[0], number[1:])
+
+    (whole, _, fraction) = number.partition('.')
+    if not (whole + fraction).isdecimal():
+        raise ValueError("%s is not a number" % (val))
+    elif len(fraction) > places:
+        raise ValueError("%s has more than %d decimal places" % (val, places))
+
+    return int(sign + whole + fraction.ljust(places, '0'))
 
 def parse_file(file):
+    if hasattr(file, 'read'):
+        data = file.read()
+        digest = blake2b(data, digest_size=16).digest()
+
+        entries = parse_cache.get(digest)
+        if entries is None:
+            entries = tuple(iter_file(BytesIO(data)))
+            parse_cache.put(digest, entries)
+
+        return list(entries)
+    else:
+        return list(iter_file(file))
+
+def parse_files(files):
+    if len(files) == 1:
+        return parse_file(files[0])
+
+    # Parse each file on its own thread, then combine the entries in the
+    # order the files were given
+    with ThreadPoolExecutor(max_workers=min(len(files), MAX_PARSE_THREADS)) as executor:
+        return list(chain.from_iterable(executor.map(parse_file, files)))
+
+def iter_file(file):
     if hasattr(file, 'read'):
         with TextIOWrapper(file, encoding='utf-8-sig') as f:
-            return parse_file_object(f)
+            yield from iter_file_object(f)
     else:
-        with open(file, "r", encoding='utf-8-sig') as f:
-            return parse_file_object(f)
+        # Files on disk can be very large, so map them into memory and only
+        # decode the fields which are needed
+        yield from iter_mapped_file(file)
 
-def get_account_number(row):
-    try:
-        return row["Account Number"]
-    except KeyError:
-        return row["Account Name/Number"]
+def register_format(portfolio_format):
+    # Formats registered later are tried first so they can take over a
+    # header which a built-in format would also match
+    PORTFOLIO_FORMATS.insert(0, portfolio_format)
+    parse_cache.clear()
 
-def parse_file_object(file):
-    AccountEntry = namedtuple('AccountEntry',
-                              'account_name symbol share_price current_value description shares')
+def resolve_format_columns(portfolio_format, columns):
     ret = []
-    r = DictReader(file)
-    for row in r:
-        symbol = row["Symbol"]
-        account = get_account_number(row)
-        description = row["Description"]
+    for field in FORMAT_COLUMN_FIELDS:
+        names = getattr(portfolio_format, field)
+        matches = list(filter(lambda x: x in columns, names))
+        if len(matches) == 0:
+            return None
+
+        ret.append(columns[matches[0]])
+
+    return ret
+
+def sniff_format(header):
+    # Like DictReader, a repeated column name refers to its last occurrence
+    columns = dict((name, idx) for (idx, name) in enumerate(header))
+    for portfolio_format in PORTFOLIO_FORMATS:
+        format_columns = resolve_format_columns(portfolio_format, columns)
+        if format_columns is not None:
+            return (portfolio_format, format_columns)
+
+    raise KeyError("Unrecognized portfolio file header: %s" % (','.join(header)))
+
+def parse_file_object(file):
+    return list(iter_file_object(file))
+
+def iter_file_object(file):
+    r = reader(file)
+    header = next(r, None)
+    if header is None:
+        return
+
+    (portfolio_format, format_columns) = sniff_format(header)
+    yield from iter_format_entries(portfolio_format,
+                                   format_columns,
+                                   len(header),
+                                   r)
+
+def iter_format_entries(portfolio_format, format_columns, num_columns, rows):
+    (account_column,
+     symbol_column,
+     description_column,
+     current_value_column,
+     quantity_column,
+     last_price_column) = format_columns
+
+    unity = Decimal(1.0)
+    for row in rows:
+        # Skip blank lines and treat missing trailing fields as empty, just
+        # like DictReader
+        if len(row) == 0:
+            if portfolio_format.ends_at_blank_line:
+                break
+            else:
+                continue
+        elif len(row) < num_columns:
+            row = row + [None] * (num_columns - len(row))
+
+        symbol = row[symbol_column]
+        account = row[account_column]
+        description = row[description_column]
         # If there is no symbol (which happens with some 401(k) funds), try
         # to use the description as the symbol
         if symbol is None or len(symbol) == 0:
@@ -44,20 +208,85 @@ def parse_file_object(file):
             credit = symbol.casefold() == "Pending Activity".casefold()
             symbol = CORE if credit else symbol.replace('*', '')
 
-            unity = Decimal(1.0)
+            current_value = parse_number_column(row[current_value_column])
+            shares = parse_number_column(row[quantity_column], current_value)
+            cost_per_share = parse_number_column(row[last_price_column], unity)
 
-            current_value = parse_number_column(row["Current Value"])
-            shares = parse_number_column(row["Quantity"], current_value)
-            cost_per_share = parse_number_column(row["Last Price"], unity)
+            yield AccountEntry(account,
+                               symbol,
+                               cost_per_share,
+                               current_value,
+                               description,
+                               shares)
 
-            entry = AccountEntry(account,
-                                 symbol,
-                                 cost_per_share,
-                                 current_value,
-                                 description,
-                                 shares)
+def iter_mapped_lines(buf):
+    start = 0
+    if buf[:len(BOM_UTF8)] == BOM_UTF8:
+        start = len(BOM_UTF8)
 
-            ret.append(entry)
+    while start < len(buf):
+        end = buf.find(b'\n', start)
+        end = len(buf) if end < 0 else end + 1
 
-    return ret
+        yield buf[start:end]
+        start = end
+
+def iter_mapped_rows(lines, format_columns):
+    # Lines with a quote are left to the csv module, since a quote only
+    # starts a quoted field when it opens the field, and a quoted field
+    # may continue onto the following lines. The reader only asks for
+    # another line while it is inside a quoted field
+    pending = []
+    def quoted_lines():
+        while True:
+            line = pending.pop() if len(pending) > 0 else next(lines, None)
+            if line is None:
+                return
+
+            text = line.decode('utf-8')
+            yield text[:-2] + '\n' if text.endswith('\r\n') else text
+
+    quoted_reader = reader(quoted_lines())
+
+    for line in lines:
+        if b'"' in line:
+            pending.append(line)
+            yield next(quoted_reader)
+            continue
+
+        if line.endswith(b'\n'):
+            line = line[:-1]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+
+        # Blank lines have no fields, just like with csv
+        if len(line) == 0:
+            yield []
+            continue
+
+        # Only decode the fields which will actually be used
+        fields = line.split(b',')
+        row = [None] * len(fields)
+        for column in format_columns:
+            if column < len(fields):
+                row[column] = fields[column].decode('utf-8')
+
+        yield row
+
+def iter_mapped_file(filename):
+    with open(filename, "rb") as f:
+        if fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as buf:
+            lines = iter_mapped_lines(buf)
+            header_line = next(lines, None)
+            if header_line is None:
+                return
 
+            header = next(reader([header_line.decode('utf-8')]), [])
+            (portfolio_format, format_columns) = sniff_format(header)
+            yield from iter_format_entries(portfolio_format,
+                                           format_columns,
+                                           len(header),
+                                           iter_mapped_rows(lines, format_columns))
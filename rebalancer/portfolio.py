@@ -3,7 +3,7 @@ from functools import reduce, partial
 from collections import defaultdict
 from math import ceil, floor
 
-from .utils import round_cents, to_dollars, is_mutual_fund, CORE
+from .utils import round_cents, to_dollars, is_mutual_fund, CORE, ZERO
 from .balance import compute_asset_differences, compute_minimal_remainder_purchase
 
 class Transaction:
@@ -34,7 +34,7 @@ class Transaction:
 
 class Account:
     def __init__(self, security_db):
-        self.__positions = {CORE : Decimal(0.0)}
+        self.__positions = {CORE : ZERO}
         self.__assets_to_symbols = {'Cash' : [CORE]}
         self.__security_db = security_db
 
@@ -61,14 +61,24 @@ class Account:
     def __getitem__(self, asset):
         return sum(map(self.__positions.__getitem__,
                        self.__assets_to_symbols[asset]),
-                   start=Decimal(0.0))
+                   start=ZERO)
+
+    def get_buy_symbols(self, buy_asset_transactions):
+        ret = {}
+        for asset in buy_asset_transactions.keys():
+            if asset not in self.__assets_to_symbols:
+                ret[asset] = self.__security_db.get_reference_security(asset)
+            else:
+                ret[asset] = self.__get_asset_symbol(asset)
+
+        return ret
 
     def get_position_transactions(self,
                                   sell_asset_transactions,
                                   buy_asset_transactions):
         ret = []
 
-        available_funds = Decimal(0.0)
+        available_funds = ZERO
         for (asset, value) in sell_asset_transactions.items():
             symbol = self.__get_asset_symbol(asset)
             position = self.__positions[symbol]
@@ -86,17 +96,13 @@ class Account:
             t = Transaction(Transaction.SELL, symbol, value, cost_per_share, shares)
             ret.append(t)
 
-        unoptomized_sale_funds = Decimal(0.0)
+        unoptomized_sale_funds = ZERO
         has_mutual_funds = False
         buy_symbols = {}
-        for (asset, value) in buy_asset_transactions.items():
-            symbol = None
-            cost_per_share = None
-            if asset not in self.__assets_to_symbols:
-                symbol = self.__security_db.get_reference_security(asset)
-            else:
-                symbol = self.__get_asset_symbol(asset)
 
+        buy_asset_symbols = self.get_buy_symbols(buy_asset_transactions)
+        for (asset, value) in buy_asset_transactions.items():
+            symbol = buy_asset_symbols[asset]
             cost_per_share = self.__security_db.get_current_price(symbol)
             shares = None
             if not self.__security_db.supports_fractional_shares(symbol):
@@ -150,7 +156,7 @@ class Account:
     def get(self, asset, default=None):
         symbols = self.__assets_to_symbols.get(asset)
         return sum(map(self.__positions.__getitem__, symbols),
-                   start=Decimal(0.0)) if symbols is not None else default
+                   start=ZERO) if symbols is not None else default
 
     def current_value(self):
         return sum(self.__positions.values())
@@ -168,8 +174,8 @@ class Account:
     def copy(self, transactions):
         account_copy = Account(self.__security_db)
 
-        sell_amount = Decimal(0.0)
-        buy_amount = Decimal(0.0)
+        sell_amount = ZERO
+        buy_amount = ZERO
 
         tmp_positions = self.__positions.copy()
         for transaction in transactions:
@@ -203,7 +209,7 @@ class AccountGroupBase:
     def current_value(self):
         return reduce(lambda x, y: x + y.current_value(),
                       self._accounts.values(),
-                      Decimal(0.0))
+                      ZERO)
 
     def __getitem__(self, asset):
         ret = self.get(asset)
@@ -254,10 +260,16 @@ class AccountGroup(AccountGroupBase):
         self._accounts[account].add_position(symbol, value)
 
     def get_transactions_to_match_target(self, target_assets):
+        asset_transactions = self.get_asset_transactions_to_match_target(target_assets)
+        self._security_db.prefetch_current_prices(self.get_buy_symbols(asset_transactions))
+
+        return self.get_position_transactions(asset_transactions)
+
+    def get_asset_transactions_to_match_target(self, target_assets):
         group_asset_differences = compute_asset_differences(self, target_assets)
-        group_up_assets = list(filter(lambda key: group_asset_differences[key] > Decimal(0.0),
+        group_up_assets = list(filter(lambda key: group_asset_differences[key] > ZERO,
                                       group_asset_differences.keys()))
-        group_down_assets = list(filter(lambda key: group_asset_differences[key] < Decimal(0.0),
+        group_down_assets = list(filter(lambda key: group_asset_differences[key] < ZERO,
                                         group_asset_differences.keys()))
 
         sell_transactions = defaultdict(dict)
@@ -267,9 +279,9 @@ class AccountGroup(AccountGroupBase):
 
         for up_asset in group_up_assets:
             for (name, account) in self._accounts.items():
-                available = account.get(up_asset, Decimal(0.0))
+                available = account.get(up_asset, ZERO)
                 difference = group_asset_differences[up_asset]
-                if difference > Decimal(0.0) and available > Decimal(0.0):
+                if difference > ZERO and available > ZERO:
 
                     value = min(available, difference)
                     sell_transactions[name][up_asset] = value
@@ -280,7 +292,7 @@ class AccountGroup(AccountGroupBase):
             for (name, account) in self._accounts.items():
                 available = cash_available[name]
                 difference = group_asset_differences[down_asset]
-                if difference < Decimal(0.0) and available > Decimal(0.0):
+                if difference < ZERO and available > ZERO:
 
                     value = min(available, -difference)
                     buy_transactions[name][down_asset] = value
@@ -288,11 +300,23 @@ class AccountGroup(AccountGroupBase):
                     cash_available[name] -= value
 
         ret = {}
-        for (name, account) in self._accounts.items():
-            sell = sell_transactions.get(name, {})
-            buy = buy_transactions.get(name, {})
+        for name in self._accounts.keys():
+            ret[name] = (sell_transactions.get(name, {}),
+                         buy_transactions.get(name, {}))
 
-            ret[name] = account.get_position_transactions(sell, buy)
+        return ret
+
+    def get_buy_symbols(self, asset_transactions):
+        ret = set()
+        for (name, (_, buy)) in asset_transactions.items():
+            ret.update(self._accounts[name].get_buy_symbols(buy).values())
+
+        return ret
+
+    def get_position_transactions(self, asset_transactions):
+        ret = {}
+        for (name, (sell, buy)) in asset_transactions.items():
+            ret[name] = self._accounts[name].get_position_transactions(sell, buy)
 
         return ret
 
@@ -316,10 +340,22 @@ class Portfolio(AccountGroupBase):
         return self._accounts.copy()
 
     def get_transactions_to_match_target(self, target_tax_groups):
-        ret = {}
+        asset_transactions = {}
         for (tax_group, target_assets) in target_tax_groups.items():
             account_group = self._accounts[tax_group]
-            ret[tax_group] = account_group.get_transactions_to_match_target(target_assets)
+            asset_transactions[tax_group] = account_group.get_asset_transactions_to_match_target(target_assets)
+
+        # Every account's purchases are known before any are priced, so the
+        # missing quotes for the whole rebalance are fetched together
+        buy_symbols = set()
+        for (tax_group, transactions) in asset_transactions.items():
+            buy_symbols.update(self._accounts[tax_group].get_buy_symbols(transactions))
+
+        self._security_db.prefetch_current_prices(buy_symbols)
+
+        ret = {}
+        for (tax_group, transactions) in asset_transactions.items():
+            ret[tax_group] = self._accounts[tax_group].get_position_transactions(transactions)
 
         return ret
 
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+from csv import reader, writer
+from decimal import Decimal
+from time import time
+
+from .utils import round_cents, is_mutual_fund
+from .cache import TTLCache
+from .parser import parse_number_column
+
+DEFAULT_QUOTE_SERVICE_URL = "https://www.alphavantage.co/query"
+# Number of quotes requested from the service at once
+DEFAULT_MAX_QUOTE_FETCHES = 4
+
+# Quotes are shared by every session in the process and follow the same
+# rules as the Quotes table: mutual fund quotes are good for the rest of the
+# (UTC) day they were taken and everything else for 15 minutes
+QUOTE_CACHE_SIZE = 4096
+QUOTE_LIFETIME = 15 * 60
+SECONDS_PER_DAY = 24 * 60 * 60
+
+quote_cache = TTLCache(QUOTE_CACHE_SIZE)
+
+# Symbols which sessions have asked for recently, so they can be kept warm
+RECENT_SYMBOL_LIFETIME = 60 * 60
+
+recent_symbols = TTLCache(QUOTE_CACHE_SIZE, RECENT_SYMBOL_LIFETIME)
+
+_quote_service_url = DEFAULT_QUOTE_SERVICE_URL
+_max_quote_fetches = DEFAULT_MAX_QUOTE_FETCHES
+
+def configure_quote_service(url = DEFAULT_QUOTE_SERVICE_URL,
+                            max_fetches = DEFAULT_MAX_QUOTE_FETCHES):
+    global _quote_service_url, _max_quote_fetches
+
+    _quote_service_url = url
+    _max_quote_fetches = max_fetches
+
+def get_current_price_from_web(symbol, service_key):
+    import urllib.request
+    import urllib.parse
+    import json
+
+    parms = {
+        'function' : 'GLOBAL_QUOTE',
+        'symbol'   : symbol,
+        'apikey'   : service_key
+    }
+    data = urllib.parse.urlencode(parms)
+    url = "%s?%s" % (_quote_service_url, data)
+    with urllib.request.urlopen(url) as f:
+        j = json.loads(f.read().decode('ascii'))
+        return round_cents(Decimal(j['Global Quote']['05. price']))
+
+def get_current_prices_from_web(symbols, service_key):
+    symbols = list(dict.fromkeys(symbols))
+    if len(symbols) == 0:
+        return {}
+    elif len(symbols) == 1:
+        return {symbols[0] : get_current_price_from_web(symbols[0], service_key)}
+
+    # Each request spends nearly all of its time waiting on the service, so
+    # threads are enough to overlap them
+    max_workers = min(len(symbols), _max_quote_fetches)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        prices = executor.map(lambda x: get_current_price_from_web(x, service_key),
+                              symbols)
+        return dict(zip(symbols, prices))
+
+def get_quote_expiration(symbol, quote_time):
+    expires = quote_time + QUOTE_LIFETIME
+    if is_mutual_fund(symbol):
+        end_of_day = (quote_time // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY
+        expires = max(expires, end_of_day)
+
+    return expires
+
+def cache_quote(symbol, price, quote_time = None):
+    now = time()
+    quote_time = now if quote_time is None else quote_time
+
+    ttl = get_quote_expiration(symbol, quote_time) - now
+    if ttl > 0:
+        quote_cache.put(symbol, price, ttl)
+
+def cache_quotes(quotes, quote_time = None):
+    for (symbol, price) in quotes:
+        cache_quote(symbol, price, quote_time)
+
+def get_cached_quotes(symbols):
+    quotes = {}
+    for symbol in symbols:
+        recent_symbols.put(symbol, True)
+
+        price = quote_cache.get(symbol)
+        if price is not None:
+            quotes[symbol] = price
+
+    return quotes
+
+# A snapshot is a CSV file with a Symbol and Price column, which can be used
+# to run against a fixed set of prices without the quote service
+SNAPSHOT_HEADER = ('Symbol', 'Price')
+
+def read_quote_snapshot(filename):
+    quotes = []
+    with open(filename, "r", newline='', encoding='utf-8-sig') as f:
+        r = reader(f)
+        header = next(r, None)
+        if header is None:
+            return quotes
+
+        columns = dict((name, idx) for (idx, name) in enumerate(header))
+        missing = [x for x in SNAPSHOT_HEADER if x not in columns]
+        if len(missing) > 0:
+            raise KeyError("Quote snapshot is missing columns: %s" % (','.join(missing)))
+
+        symbol_column = columns['Symbol']
+        price_column = columns['Price']
+        for row in r:
+            if len(row) == 0:
+                continue
+
+            # Rounded to cents like the quotes from the service, which have
+            # more decimal places
+            price = round_cents(parse_number_column(row[price_column]))
+            quotes.append((row[symbol_column], price))
+
+    return quotes
+
+def write_quote_snapshot(filename, quotes):
+    with open(filename, "w", newline='', encoding='utf-8') as f:
+        w = writer(f)
+        w.writerow(SNAPSHOT_HEADER)
+        for (symbol, price) in sorted(quotes):
+            w.writerow((symbol, round_cents(price)))
+
+def load_quote_snapshot(filename, database = None):
+    quotes = read_quote_snapshot(filename)
+
+    # Snapshot quotes never expire from the cache, so a run sees the same
+    # prices from start to finish
+    for (symbol, price) in quotes:
+        quote_cache.put(symbol, price)
+
+    if database is not None:
+        database.add_quotes(quotes)
+        database.commit()
+
+    return len(quotes)
+
+def save_quote_snapshot(filename, database = None):
+    if database is not None:
+        quotes = database.get_latest_quotes().items()
+    else:
+        quotes = quote_cache.items()
+
+    write_quote_snapshot(filename, quotes)
+    return len(quotes)
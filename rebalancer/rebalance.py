@@ -1,10 +1,12 @@
 from decimal import Decimal
-from collections import defaultdict, deque
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from itertools import chain
 from functools import partial, cmp_to_key
+from operator import itemgetter
 
-from .utils import compute_percent_difference
+from .utils import compute_percent_difference, ZERO
 from .db import AssetTaxGroup
 
 class RebalanceMode:
@@ -13,6 +15,12 @@ class RebalanceMode:
     NO_SELL         = "Rebalance without selling"
     RESHUFFLE       = "Move without rebalancing"
 
+RebalanceResult = namedtuple('RebalanceResult',
+                             'rebalance_mode targets transactions new_portfolio error',
+                             defaults=(None,))
+
+MAX_REBALANCE_THREADS = 4
+
 def get_actual_asset_percentages(portfolio):
     current_value = portfolio.current_value()
     ret = {}
@@ -51,8 +59,12 @@ class Rebalancer:
             target_asset_values = dict(portfolio.items())
             target_asset_percentages = get_actual_asset_percentages(portfolio)
         else:
-            target_asset_group_values = self.__account_target.get_target_asset_group_values(portfolio)
-            target_asset_values = self.__account_target.get_target_asset_values(portfolio)
+            # The account target shares its results, so copy the ones which
+            # are updated during allocation
+            target_asset_group_values = defaultdict(Decimal,
+                                                    self.__account_target.get_target_asset_group_values(portfolio))
+            target_asset_values = defaultdict(Decimal,
+                                              self.__account_target.get_target_asset_values(portfolio))
             target_asset_percentages = self.__account_target.get_target_asset_percentages(portfolio)
 
         return self.__compute_target_asset_values_parameterized(portfolio,
@@ -61,6 +73,54 @@ class Rebalancer:
                                                                 target_asset_values,
                                                                 target_asset_percentages)
 
+    def rebalance(self, portfolio, rebalance_mode, asset_sales_mask):
+        targets = self.compute_target_asset_values(portfolio,
+                                                   rebalance_mode,
+                                                   asset_sales_mask)
+        transactions = portfolio.get_transactions_to_match_target(targets)
+        new_portfolio = portfolio.copy_with_transactions_applied(transactions)
+
+        return RebalanceResult(rebalance_mode, targets, transactions, new_portfolio)
+
+    def __try_rebalance(self, portfolio, rebalance_mode, asset_sales_mask):
+        # A mode which can't be computed for this portfolio shouldn't lose
+        # the results of the others
+        try:
+            return self.rebalance(portfolio, rebalance_mode, asset_sales_mask)
+        except Exception as ex:
+            return RebalanceResult(rebalance_mode, None, None, None, ex)
+
+    def compare_rebalance_modes(self, portfolio, rebalance_modes, asset_sales_mask):
+        rebalance_modes = list(rebalance_modes)
+        if len(rebalance_modes) == 0:
+            return []
+
+        # Compute the account targets before starting so every mode shares
+        # them instead of each thread computing its own
+        if any(map(lambda x: x != RebalanceMode.RESHUFFLE, rebalance_modes)):
+            self.__account_target.get_target_asset_group_values(portfolio)
+            self.__account_target.get_target_asset_values(portfolio)
+            self.__account_target.get_target_asset_percentages(portfolio)
+
+        # An account buys an asset it doesn't hold with the asset's reference
+        # security, so fetch any of those which are missing once here rather
+        # than in every mode's thread
+        assets = set(self.__account_target.get_asset_targets().keys())
+        assets.update(portfolio.keys())
+        assets.discard(self.__security_db.Assets.CASH)
+
+        symbols = map(self.__security_db.get_reference_security, assets)
+        self.__security_db.prefetch_current_prices(symbols)
+
+        # Neither the portfolio nor the targets are changed by rebalancing, so
+        # the modes can be evaluated at the same time
+        rebalance = partial(self.__try_rebalance,
+                            portfolio,
+                            asset_sales_mask=asset_sales_mask)
+        max_workers = min(len(rebalance_modes), MAX_REBALANCE_THREADS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(rebalance, rebalance_modes))
+
     def __compute_target_asset_values_parameterized(self,
                                                     portfolio,
                                                     seed_asset_tax_groups,
@@ -72,17 +132,17 @@ class Rebalancer:
 
         targets = defaultdict(partial(defaultdict, Decimal))
         for (asset, tax_status) in seed_asset_tax_groups:
-            value = current_asset_values[tax_status].get(asset, Decimal(0.0))
+            value = current_asset_values[tax_status].get(asset, ZERO)
             CASH = self.__security_db.Assets.CASH
 
             group = self.__security_db.get_asset_group_for_asset(asset)
-            target_value = Decimal(0.0) if asset == CASH else value
+            target_value = ZERO if asset == CASH else value
             targets[tax_status][asset] = target_value
 
             tax_status_amounts[tax_status] -= target_value
-            target_asset_group_values[group] = max(Decimal(0.0),
+            target_asset_group_values[group] = max(ZERO,
                                                    target_asset_group_values[group] - target_value)
-            target_asset_values[asset] = max(Decimal(0.0),
+            target_asset_values[asset] = max(ZERO,
                                              target_asset_values[asset] - target_value)
 
         # Idea for new account allocation policy:
@@ -99,36 +159,40 @@ class Rebalancer:
 
         affinities_by_tax_status = dict(map(tax_group_asset_affinity_deque,
                                             portfolio.assets_by_tax_status().keys()))
-        while len(affinities_by_tax_status) > 0:
-            sorted_tax_groups = sorted(affinities_by_tax_status.keys(),
-                                       key=tax_status_amounts.get)
-            for tax_status in sorted_tax_groups:
+        # Every tax group is visited once per round and its amount changes on
+        # each visit, so the whole order is rebuilt for the next round. Only
+        # tax groups with space and assets left are carried over, and each
+        # keeps the position it was added in to break ties
+        next_round = [(tax_status_amounts[tax_status], idx, tax_status)
+                      for (idx, tax_status) in enumerate(affinities_by_tax_status.keys())]
+        while len(next_round) > 0:
+            next_round.sort(key=itemgetter(0, 1))
+            (current_round, next_round) = (next_round, [])
+            for (tax_status_amount, idx, tax_status) in current_round:
                 affinities = affinities_by_tax_status[tax_status]
                 if len(affinities) > 0:
                     asset = affinities.popleft()
                     group = self.__security_db.get_asset_group_for_asset(asset)
 
-                    alloc_amount = min(tax_status_amounts[tax_status],
+                    alloc_amount = min(tax_status_amount,
                                        target_asset_values[asset],
                                        target_asset_group_values[group])
 
                     targets[tax_status][asset] += alloc_amount
 
-                    tax_status_amounts[tax_status] -= alloc_amount
+                    tax_status_amount -= alloc_amount
+                    tax_status_amounts[tax_status] = tax_status_amount
                     target_asset_group_values[group] -= alloc_amount
                     target_asset_values[asset] -= alloc_amount
 
-                    if tax_status_amounts[tax_status] <= Decimal(0.0):
-                        del affinities_by_tax_status[tax_status]
-
-                else:
-                    del affinities_by_tax_status[tax_status]
+                    if tax_status_amount > ZERO and len(affinities) > 0:
+                        next_round.append((tax_status_amount, idx, tax_status))
 
         #If there is leftover cash within a tax group, first allocate it if
         #there is an asset below its target allcoation
         for tax_status in portfolio.assets_by_tax_status().keys():
             tax_status_amount = tax_status_amounts[tax_status]
-            if tax_status_amount > Decimal(0.0):
+            if tax_status_amount > ZERO:
                 assets = self.__account_target.get_tax_group_asset_affinity(tax_status)
 
                 # Add to each asset with affinity
@@ -139,7 +203,7 @@ class Rebalancer:
                     targets[tax_status][asset] += to_add
 
                     tax_status_amounts[tax_status] -= to_add
-                    if tax_status_amounts[tax_status] <= Decimal(0.0):
+                    if tax_status_amounts[tax_status] <= ZERO:
                         break
 
         #If there is still leftover cash within a tax group, allocate it based
@@ -147,7 +211,7 @@ class Rebalancer:
         #the assets which have affinity for that group
         for tax_status in portfolio.assets_by_tax_status().keys():
             tax_status_amount = tax_status_amounts[tax_status]
-            if tax_status_amount > Decimal(0.0):
+            if tax_status_amount > ZERO:
                 assets = self.__account_target.get_tax_group_asset_affinity(tax_status)
 
                 sum_percentage = sum(map(target_asset_percentages.get, assets))
@@ -163,7 +227,7 @@ class Rebalancer:
                     targets[tax_status][asset] += to_add
 
                     tax_status_amounts[tax_status] -= to_add
-                    if tax_status_amounts[tax_status] <= Decimal(0.0):
+                    if tax_status_amounts[tax_status] <= ZERO:
                         break
 
         return targets
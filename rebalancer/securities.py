@@ -1,24 +1,78 @@
 from collections import namedtuple, defaultdict
 from decimal import Decimal
+from threading import Lock, Thread, Event
+from time import time
+from types import MappingProxyType
+import logging
 
-from .utils import to_enum_name, is_mutual_fund, round_cents
-from .db import Database
-
-def get_current_price_from_web(symbol, service_key):
-    import urllib.request
-    import urllib.parse
-    import json
-
-    parms = {
-        'function' : 'GLOBAL_QUOTE',
-        'symbol'   : symbol,
-        'apikey'   : service_key
-    }
-    data = urllib.parse.urlencode(parms)
-    url = "https://www.alphavantage.co/query?%s" % data
-    with urllib.request.urlopen(url) as f:
-        j = json.loads(f.read().decode('ascii'))
-        return round_cents(Decimal(j['Global Quote']['05. price']))
+from .utils import to_enum_name, is_mutual_fund
+from .db import Database, get_reference_data_version
+from .quotes import get_current_price_from_web, get_current_prices_from_web
+from .quotes import cache_quote, cache_quotes, get_cached_quotes
+from .quotes import get_quote_expiration, recent_symbols
+
+logger = logging.getLogger(__name__)
+
+ReferenceData = namedtuple('ReferenceData',
+                           'version asset_classes asset_groups security_asset_groups '
+                           'asset_securities default_securities Assets AssetGroups')
+
+_reference_data = None
+_reference_data_lock = Lock()
+
+def create_assets(database):
+    assets = {}
+    for (abbrev, _) in database.get_asset_abbreviations():
+        assets[to_enum_name(abbrev)] = abbrev
+
+    AssetsClass = namedtuple('AssetsClass', ' '.join(assets.keys()))
+    return AssetsClass(*assets.values())
+
+def create_asset_groups(database):
+    asset_groups = {}
+    for (name, _) in database.get_asset_groups():
+        asset_groups[to_enum_name(name)] = name
+
+    AssetGroupsClass = namedtuple('AssetGroupsClass',
+                                  ' '.join(asset_groups.keys()))
+    return AssetGroupsClass(*asset_groups.values())
+
+def load_reference_data(database, version):
+    asset_classes = {}
+    asset_groups = {}
+    security_asset_groups = {}
+    asset_securities = defaultdict(list)
+    for security in database.get_securities():
+        asset_classes[security.symbol] = security.asset
+        asset_groups[security.asset] = security.asset_group
+        security_asset_groups[security.symbol] = security.asset_group
+        asset_securities[security.asset].append(security.symbol)
+
+    asset_securities = dict(map(lambda x: (x[0], tuple(x[1])),
+                                asset_securities.items()))
+    default_securities = dict(database.get_default_securities())
+
+    # Every session shares this snapshot, so only hand out read-only views
+    return ReferenceData(version,
+                         MappingProxyType(asset_classes),
+                         MappingProxyType(asset_groups),
+                         MappingProxyType(security_asset_groups),
+                         MappingProxyType(asset_securities),
+                         MappingProxyType(default_securities),
+                         create_assets(database),
+                         create_asset_groups(database))
+
+def get_reference_data(database):
+    global _reference_data
+
+    # Read the version before loading so a change made while loading causes
+    # the next caller to reload
+    version = get_reference_data_version()
+    with _reference_data_lock:
+        if _reference_data is None or _reference_data.version != version:
+            _reference_data = load_reference_data(database, version)
+
+        return _reference_data
 
 class SecurityDatabase:
     def __init__(self, account_entries = None, database = None, quote_key = None, partial_share_trades = False):
@@ -57,25 +111,63 @@ class SecurityDatabase:
                 if symbol in self.__asset_classes:
                     assets_with_prices.add(self.__asset_classes[symbol])
 
+            # Collect every reference security which needs a price so the
+            # missing quotes can be fetched together
+            symbols = []
             for asset in assets:
                 if asset != self.Assets.CASH and asset not in assets_with_prices:
-                    symbol = self.get_reference_security(asset)
-                    db_price = db.get_quote(symbol)
-                    if db_price is None:
-                        current_price = get_current_price_from_web(symbol, self.__quote_key)
-                        db.add_quote(symbol, current_price)
-                        self.__current_prices[symbol] = current_price
-                    else:
-                        self.__current_prices[symbol] = db_price
+                    symbols.append(self.get_reference_security(asset))
+
+            cached_prices = get_cached_quotes(symbols)
+            self.__current_prices.update(cached_prices)
+
+            symbols = [x for x in symbols if x not in cached_prices]
+            db_prices = {}
+            for (symbol, (price, quote_time)) in db.get_quotes(symbols).items():
+                cache_quote(symbol, price, quote_time)
+                db_prices[symbol] = price
+            self.__current_prices.update(db_prices)
+
+            missing_symbols = [x for x in symbols if x not in db_prices]
+            web_prices = get_current_prices_from_web(missing_symbols, self.__quote_key)
+            db.add_quotes(web_prices.items())
+            cache_quotes(web_prices.items())
+            self.__current_prices.update(web_prices)
 
             db.commit()
 
+    def prefetch_current_prices(self, symbols):
+        missing_symbols = [x for x in symbols
+                           if x not in self.__current_prices and \
+                              self.get_asset_class(x) != self.Assets.CASH]
+
+        cached_prices = get_cached_quotes(missing_symbols)
+        self.__current_prices.update(cached_prices)
+
+        if self.__quote_key is not None:
+            missing_symbols = [x for x in missing_symbols if x not in cached_prices]
+            web_prices = get_current_prices_from_web(missing_symbols, self.__quote_key)
+            cache_quotes(web_prices.items())
+            self.__current_prices.update(web_prices)
+
+            if len(web_prices) > 0:
+                with Database() as db:
+                    db.add_quotes(web_prices.items())
+                    db.commit()
+
     def get_current_price(self, symbol):
         if self.get_asset_class(symbol) == self.Assets.CASH:
             return Decimal(1.0)
-        elif self.__quote_key is not None and symbol not in self.__current_prices:
-            current_price = get_current_price_from_web(symbol, self.__quote_key)
-            self.__current_prices[symbol] = current_price
+        elif symbol not in self.__current_prices:
+            # Quotes from other sessions (or a loaded snapshot) are used even
+            # without a quote service
+            current_price = get_cached_quotes((symbol,)).get(symbol)
+            if current_price is None and self.__quote_key is not None:
+                current_price = get_current_price_from_web(symbol, self.__quote_key)
+                cache_quote(symbol, current_price)
+
+            if current_price is not None:
+                self.__current_prices[symbol] = current_price
 
         return self.__current_prices.get(symbol, Decimal(10.00))
 
@@ -87,43 +179,113 @@ class SecurityDatabase:
         return self.__default_securities[asset]
 
     def __init_from_db(self, db):
-        self.__create_securities(db)
-        self.__create_assets(db)
-        self.__create_asset_groups(db)
-        self.__create_default_securities(db)
-
-    def __create_securities(self, database):
-        asset_classes = {}
-        asset_groups = {}
-        security_asset_groups = {}
-        asset_securities = defaultdict(list)
-        for security in database.get_securities():
-            asset_classes[security.symbol] = security.asset
-            asset_groups[security.asset] = security.asset_group
-            security_asset_groups[security.symbol] = security.asset_group
-            asset_securities[security.asset].append(security.symbol)
-
-        self.__asset_groups = asset_groups
-        self.__asset_classes = asset_classes
-        self.__security_asset_groups = security_asset_groups
-        self.__asset_securities = asset_securities
-
-    def __create_default_securities(self, database):
-        self.__default_securities = dict(database.get_default_securities())
-
-    def __create_assets(self, database):
-        assets = {}
-        for (abbrev, _) in database.get_asset_abbreviations():
-            assets[to_enum_name(abbrev)] = abbrev
-
-        AssetsClass = namedtuple('AssetsClass', ' '.join(assets.keys()))
-        self.Assets = AssetsClass(*assets.values())
-
-    def __create_asset_groups(self, database):
-        asset_groups = {}
-        for (name, _) in database.get_asset_groups():
-            asset_groups[to_enum_name(name)] = name
-
-        AssetGroupsClass = namedtuple('AssetGroupsClass',
-                                      ' '.join(asset_groups.keys()))
-        self.AssetGroups = AssetGroupsClass(*asset_groups.values())
+        reference_data = get_reference_data(db)
+
+        self.__asset_groups = reference_data.asset_groups
+        self.__asset_classes = reference_data.asset_classes
+        self.__security_asset_groups = reference_data.security_asset_groups
+        self.__asset_securities = reference_data.asset_securities
+        self.__default_securities = reference_data.default_securities
+        self.Assets = reference_data.Assets
+        self.AssetGroups = reference_data.AssetGroups
+
+class QuotePrefetcher:
+    # Quotes are refreshed this many seconds before they would go stale
+    DEFAULT_LEAD_TIME = 60
+    # Longest time to sleep before looking for new symbols to refresh
+    POLL_INTERVAL = 30
+    # Time to wait before retrying a symbol which failed to refresh
+    RETRY_INTERVAL = 5 * 60
+
+    def __init__(self, quote_key, rate_limit, lead_time = DEFAULT_LEAD_TIME):
+        self.__quote_key = quote_key
+        # Smallest number of seconds between two requests to the service,
+        # given a limit in requests per minute
+        self.__min_interval = 60 / rate_limit
+        self.__lead_time = lead_time
+        self.__next_refresh = {}
+        self.__last_fetch = None
+        self.__stop = Event()
+        self.__thread = Thread(target=self.__run,
+                               name="QuotePrefetcher",
+                               daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def __get_symbols(self, db):
+        reference_data = get_reference_data(db)
+
+        symbols = [symbol for (asset, symbol) in reference_data.default_securities.items()
+                   if asset != reference_data.Assets.CASH]
+        for symbol in recent_symbols.keys():
+            if reference_data.asset_classes.get(symbol) not in (None, reference_data.Assets.CASH):
+                symbols.append(symbol)
+
+        return list(dict.fromkeys(symbols))
+
+    def __load_quotes(self, db, symbols):
+        # Start from any quotes which are still fresh so a restart doesn't
+        # fetch everything again
+        for (symbol, (price, quote_time)) in db.get_quotes(symbols).items():
+            cache_quote(symbol, price, quote_time)
+            self.__next_refresh[symbol] = get_quote_expiration(symbol, quote_time) - self.__lead_time
+
+        for symbol in symbols:
+            self.__next_refresh.setdefault(symbol, time())
+
+    def __wait_for_rate_limit(self):
+        if self.__last_fetch is not None:
+            delay = self.__last_fetch + self.__min_interval - time()
+            if delay > 0:
+                self.__stop.wait(delay)
+
+        self.__last_fetch = time()
+
+    def __refresh(self, db, symbol):
+        self.__wait_for_rate_limit()
+        if self.__stop.is_set():
+            return
+
+        try:
+            price = get_current_price_from_web(symbol, self.__quote_key)
+        except Exception as ex:
+            logger.warning("Unable to refresh quote for %s: %s", symbol, ex)
+            self.__next_refresh[symbol] = time() + self.RETRY_INTERVAL
+            return
+
+        quote_time = time()
+        db.add_quotes(((symbol, price),))
+        db.commit()
+        cache_quote(symbol, price, quote_time)
+        self.__next_refresh[symbol] = get_quote_expiration(symbol, quote_time) - self.__lead_time
+
+    def __refresh_due(self):
+        with Database() as db:
+            symbols = self.__get_symbols(db)
+            self.__load_quotes(db, [x for x in symbols if x not in self.__next_refresh])
+
+            for symbol in sorted(symbols, key=self.__next_refresh.__getitem__):
+                if self.__stop.is_set() or self.__next_refresh[symbol] > time():
+                    break
+
+                self.__refresh(db, symbol)
+
+            next_refresh = min(map(self.__next_refresh.__getitem__, symbols),
+                               default=time() + self.POLL_INTERVAL)
+
+        return max(0, min(next_refresh - time(), self.POLL_INTERVAL))
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                delay = self.__refresh_due()
+            except Exception:
+                logger.exception("Unable to refresh quotes")
+                delay = self.POLL_INTERVAL
+
+            self.__stop.wait(delay)
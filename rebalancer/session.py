@@ -2,15 +2,27 @@ from types import SimpleNamespace
 from collections import defaultdict, namedtuple
 from decimal import Decimal
 from functools import partial
+from copy import copy
+from io import BytesIO
+from hashlib import blake2b
 
-from .db import Database
+from .db import Database, get_reference_data_version, get_user_config_version
 from .utils import to_enum_name, is_mutual_fund, CORE
 from .crypto import hash_user_token, hash_account_name, decrypt_account_description
-from .parser import parse_file, parse_file_object
+from .parser import parse_file, parse_files, parse_file_object
 from .securities import SecurityDatabase
 from .portfolio import Portfolio
 from .target import AccountTarget
 from .rebalance import Rebalancer
+from .cache import TTLCache
+from .quotes import QUOTE_LIFETIME
+
+# Sessions are kept for as long as the quotes they were priced with, so a form
+# resubmitted with different credits doesn't parse, query, or decrypt anything
+SESSION_CACHE_SIZE = 64
+SESSION_LIFETIME = QUOTE_LIFETIME
+
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_LIFETIME)
 
 def create_tax_status(database):
     tax_status = {}
@@ -23,6 +35,35 @@ def create_tax_status(database):
 def get_account_info(database, user_token, account, account_name):
     return database.get_account_info(user_token, account_hash, account_name)
 
+def get_session(user_token,
+                db,
+                files,
+                taxable_credit = None,
+                tax_deferred_credit = None,
+                quote_key = None,
+                fractional_shares = False):
+    data = [file.read() for file in files]
+    key = (user_token,
+           quote_key,
+           fractional_shares,
+           get_reference_data_version(),
+           get_user_config_version(user_token),
+           tuple(map(lambda x: blake2b(x, digest_size=16).digest(), data)))
+
+    session = session_cache.get(key)
+    if session is None:
+        session = Session(user_token,
+                          db,
+                          list(map(BytesIO, data)),
+                          taxable_credit,
+                          tax_deferred_credit,
+                          quote_key,
+                          fractional_shares)
+        session_cache.put(key, session)
+        return session
+
+    return session.with_credits(taxable_credit, tax_deferred_credit)
+
 class Session:
     def __init__(self,
                  user_token,
@@ -35,11 +76,19 @@ class Session:
         self.__user_token = user_token
         self.__account_info = {}
 
-        self.__account_entries = None if filename is None else parse_file(filename)
+        self.__account_entries = None
+        if isinstance(filename, (list, tuple)):
+            self.__account_entries = parse_files(filename)
+        elif filename is not None:
+            self.__account_entries = parse_file(filename)
+
         self.__securities_db = SecurityDatabase(self.__account_entries, db, quote_key, fractional_shares)
         self.__account_target = AccountTarget(user_token, self.__securities_db, db)
         self.__rebalancer = Rebalancer(self.__securities_db, self.__account_target)
 
+        self.__taxable_credit = taxable_credit
+        self.__tax_deferred_credit = tax_deferred_credit
+        self.__tax_status = None
         self.__portfolio = None
         if self.__account_entries is not None:
             account_names = set(map(lambda x: x.account_name,
@@ -48,40 +97,62 @@ class Session:
             account_info_iter = db.get_account_infos(user_token, account_names)
             self.__account_info = dict(zip(account_names, account_info_iter))
 
-            TaxStatus = create_tax_status(db)
-            self.__portfolio = Portfolio(self.__securities_db, TaxStatus)
+            self.__tax_status = create_tax_status(db)
+            self.__portfolio = self.__create_portfolio()
+
+    def __create_portfolio(self):
+        # Everything needed is loaded when the session is created, so the
+        # portfolio can be rebuilt without the database
+        TaxStatus = self.__tax_status
+        taxable_credit = self.__taxable_credit
+        tax_deferred_credit = self.__tax_deferred_credit
+
+        portfolio = Portfolio(self.__securities_db, TaxStatus)
 
-            #credits = self.__get_credit_dict(TaxStatus, db, taxable_credit, tax_deferred_credit)
+        #credits = self.__get_credit_dict(TaxStatus, db, taxable_credit, tax_deferred_credit)
 
-            for account_entry in self.__account_entries:
-                if self.__securities_db.contains_symbol(account_entry.symbol):
-                    info = self.__get_account_info(db, account_entry.account_name)
-                    if info is not None:
-                        current_value = account_entry.current_value
-                        description = info.description if info.description is not None else account_entry.account_name
+        for account_entry in self.__account_entries:
+            if self.__securities_db.contains_symbol(account_entry.symbol):
+                info = self.__account_info[account_entry.account_name]
+                if info is not None:
+                    current_value = account_entry.current_value
+                    description = info.description if info.description is not None else account_entry.account_name
 
-                        self.__portfolio.add_position(description,
-                                                      info.tax_status,
-                                                      account_entry.symbol,
-                                                      current_value)
+                    portfolio.add_position(description,
+                                           info.tax_status,
+                                           account_entry.symbol,
+                                           current_value)
 
-            for (account_name, account_info) in self.__account_info.items():
-                if account_info is not None and account_info.is_default != 0:
-                    if taxable_credit is not None and account_info.tax_status == TaxStatus.TAXABLE:
-                        description = account_info.description if account_info.description is not None else account_entry.account_name
+        for (account_name, account_info) in self.__account_info.items():
+            if account_info is not None and account_info.is_default != 0:
+                if taxable_credit is not None and account_info.tax_status == TaxStatus.TAXABLE:
+                    description = account_info.description if account_info.description is not None else account_entry.account_name
 
-                        self.__portfolio.add_position(description,
-                                                      account_info.tax_status,
-                                                      CORE,
-                                                      taxable_credit)
+                    portfolio.add_position(description,
+                                           account_info.tax_status,
+                                           CORE,
+                                           taxable_credit)
 
-                    if tax_deferred_credit is not None and account_info.tax_status == TaxStatus.TAX_DEFERRED:
-                        description = account_info.description if account_info.description is not None else account_entry.account_name
+                if tax_deferred_credit is not None and account_info.tax_status == TaxStatus.TAX_DEFERRED:
+                    description = account_info.description if account_info.description is not None else account_entry.account_name
 
-                        self.__portfolio.add_position(description,
-                                                      account_info.tax_status,
-                                                      CORE,
-                                                      tax_deferred_credit)
+                    portfolio.add_position(description,
+                                           account_info.tax_status,
+                                           CORE,
+                                           tax_deferred_credit)
+
+        return portfolio
+
+    def with_credits(self, taxable_credit = None, tax_deferred_credit = None):
+        # Only the portfolio depends on the credits, so the new session shares
+        # the parsed entries, account information, targets and prices
+        session = copy(self)
+        session.__taxable_credit = taxable_credit
+        session.__tax_deferred_credit = tax_deferred_credit
+        if session.__account_entries is not None:
+            session.__portfolio = session.__create_portfolio()
+
+        return session
 
     def get_portfolio(self):
         return self.__portfolio
@@ -97,10 +168,3 @@ class Session:
 
     def get_account_entries(self):
         return self.__account_entries.copy()
-
-    def __get_account_info(self, database, account_name):
-        if account_name not in self.__account_info:
-            info = database.get_account_info(self.__user_token, account_name)
-            self.__account_info[account_name] = info
-
-        return self.__account_info[account_name]
@@ -3,10 +3,15 @@ from decimal import Decimal
 
 from .crypto import hash_user_token_with_salt
 from .db import Database
-from .utils import round_cents, to_enum_name
+from .utils import round_cents, to_enum_name, DefaultMappingView
+from .cache import TTLCache
 
 DEFAULT = "DEFAULT"
 
+# Only the results for the last few portfolio values are kept, since a cached
+# session is reused with many different credits
+TARGET_CACHE_SIZE = 32
+
 def get_asset_targets_by_id(database, target_types, user_token):
     ret = {}
     for (asset, target, target_type) in database.get_asset_targets(user_token):
@@ -71,6 +76,7 @@ def get_asset_sales_mask(database, user_token):
 class AccountTarget:
     def __init__(self, user_token, security_db, database):
         self.__security_db = security_db
+        self.__target_cache = TTLCache(TARGET_CACHE_SIZE)
         self.__init_from_db(user_token, security_db, database)
 
     def __init_from_db(self, user_token, security_db, db):
@@ -100,24 +106,58 @@ class AccountTarget:
     def get_asset_targets(self):
         return self.__asset_targets.copy()
 
+    def __get_cached(self, compute, portfolio):
+        # The targets are loaded once, so the results only depend on the
+        # portfolio's value. The value's exact representation is part of the
+        # key since it carries through to the results. The results are shared
+        # by every caller, so only hand out read-only views
+        key = (compute.__name__, portfolio.current_value().as_tuple())
+        ret = self.__target_cache.get(key)
+        if ret is None:
+            ret = DefaultMappingView(compute(portfolio), Decimal)
+            self.__target_cache.put(key, ret)
+
+        return ret
+
     def get_target_asset_percentages(self, portfolio):
+        return self.__get_cached(self.__compute_target_asset_percentages, portfolio)
+
+    def __compute_target_asset_percentages(self, portfolio):
         current_value = portfolio.current_value()
         ret = defaultdict(Decimal)
         max_percent = lambda: Decimal(1.0) - sum(ret.values(), Decimal(0.0))
 
+        # Until an asset is updated a second time, adding each new value to a
+        # running total sums them in the same order as sum(ret.values())
+        allocated = Decimal(0.0)
+
         remainder_percentages = {}
         for (asset, (target, target_type)) in self.__asset_targets.items():
             if target_type == self.TargetTypes.PERCENT:
-                ret[asset] = min(target, max_percent())
+                ret[asset] = min(target, Decimal(1.0) - allocated)
             elif target_type == self.TargetTypes.DOLLARS:
-                percent = min(target / current_value, max_percent())
+                percent = min(target / current_value, Decimal(1.0) - allocated)
                 ret[asset] = percent
             elif target_type == self.TargetTypes.PERCENT_REMAINDER:
                 remainder_percentages[asset] = target
+                continue
             else:
                 raise KeyError("Invalid TargetType: %s" % (target_type))
 
-        remainder_percent = max_percent()
+            allocated += ret[asset]
+
+        remainder_percent = Decimal(1.0) - allocated
+        if remainder_percent > Decimal(0.0) and len(remainder_percentages) > 0:
+            for (asset, target) in remainder_percentages.items():
+                percent = min(target * remainder_percent, Decimal(1.0) - allocated)
+                ret[asset] += percent
+                allocated += ret[asset]
+
+            remainder_percent = Decimal(1.0) - allocated
+
+        # Any later passes only hand out what rounding left over. They add to
+        # existing values, which changes the order of the sum, so use the full
+        # sum to get exactly the same result
         while remainder_percent > Decimal(0.0) and len(remainder_percentages) > 0:
             for (asset, target) in remainder_percentages.items():
                 percent = min(target * remainder_percent, max_percent())
@@ -130,6 +170,9 @@ class AccountTarget:
         return ret
 
     def get_target_asset_group_percentages(self, portfolio):
+        return self.__get_cached(self.__compute_target_asset_group_percentages, portfolio)
+
+    def __compute_target_asset_group_percentages(self, portfolio):
         target_asset_percentages = self.get_target_asset_percentages(portfolio)
 
         ret = defaultdict(Decimal)
@@ -140,10 +183,17 @@ class AccountTarget:
         return ret
 
     def get_target_asset_values(self, portfolio):
+        return self.__get_cached(self.__compute_target_asset_values, portfolio)
+
+    def __compute_target_asset_values(self, portfolio):
         current_value = portfolio.current_value()
         targets = defaultdict(Decimal)
-        max_amount = lambda: current_value - round_cents(sum(targets.values(),
-                                                             Decimal(0.0)))
+
+        # Keep a running total of the targets instead of summing them for
+        # every asset. The amounts are whole cents, so the order they are
+        # added in doesn't change the total
+        allocated = Decimal(0.0)
+        max_amount = lambda: current_value - round_cents(allocated)
 
         remainder_percentages = {}
         for (asset, (target, target_type)) in self.__asset_targets.items():
@@ -155,15 +205,19 @@ class AccountTarget:
                 targets[asset] = amount
             elif target_type == self.TargetTypes.PERCENT_REMAINDER:
                 remainder_percentages[asset] = target
+                continue
             else:
                 raise KeyError("Invalid TargetType: %s" % (target_type))
 
+            allocated += amount
+
         remainder_value = max_amount()
         while remainder_value > Decimal(0) and len(remainder_percentages) > 0:
             for (asset, target) in remainder_percentages.items():
                 computed_amount = max(Decimal(.01), round_cents(target * remainder_value))
                 amount = min(computed_amount, max_amount())
                 targets[asset] += amount
+                allocated += amount
 
             remainder_value = max_amount()
 
@@ -172,6 +226,9 @@ class AccountTarget:
         return targets
 
     def get_target_asset_group_values(self, portfolio):
+        return self.__get_cached(self.__compute_target_asset_group_values, portfolio)
+
+    def __compute_target_asset_group_values(self, portfolio):
         targets = defaultdict(Decimal)
         target_asset_values = self.get_target_asset_values(portfolio)
 
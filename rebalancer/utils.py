@@ -1,5 +1,6 @@
 from decimal import Decimal
 from os import urandom
+from collections.abc import Mapping
 
 def to_dollars(value):
     value = round_cents(value)
@@ -51,3 +52,31 @@ def get_token_from_file():
     return user_token
 
 CORE = 'CORE'
+
+# Decimal is immutable, so hot paths share one zero instead of constructing it
+ZERO = Decimal(0)
+
+class DefaultMappingView(Mapping):
+    # A read-only view of a mapping which, like a defaultdict, returns a
+    # default for a missing key, but without adding it to the mapping
+    def __init__(self, values, default_factory):
+        self.__values = dict(values)
+        self.__default_factory = default_factory
+
+    def __getitem__(self, key):
+        try:
+            return self.__values[key]
+        except KeyError:
+            return self.__default_factory()
+
+    def __contains__(self, key):
+        return key in self.__values
+
+    def get(self, key, default=None):
+        return self.__values.get(key, default)
+
+    def __iter__(self):
+        return iter(self.__values)
+
+    def __len__(self):
+        return len(self.__values)
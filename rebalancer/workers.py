@@ -0,0 +1,48 @@
+from atexit import register
+from threading import Lock
+
+# Work lists shorter than this are run in the calling process since starting
+# the work in another process would cost more than doing it
+DEFAULT_INLINE_THRESHOLD = 2
+
+_pool = None
+_pool_lock = Lock()
+_processes = None
+_inline_threshold = DEFAULT_INLINE_THRESHOLD
+
+def configure_worker_pool(processes = None,
+                          inline_threshold = DEFAULT_INLINE_THRESHOLD):
+    global _processes, _inline_threshold
+
+    shutdown_worker_pool()
+
+    _processes = processes
+    _inline_threshold = inline_threshold
+
+def get_worker_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            from multiprocessing import Pool
+            _pool = Pool(_processes)
+
+        return _pool
+
+def shutdown_worker_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+
+def parallel_map(func, iterable):
+    work = list(iterable)
+    if len(work) < _inline_threshold:
+        return list(map(func, work))
+    else:
+        return get_worker_pool().map(func, work)
+
+register(shutdown_worker_pool)
@@ -0,0 +1,68 @@
+import unittest
+from os import path
+from io import BytesIO
+from decimal import Decimal
+
+from rebalancer.parser import parse_file, parse_number_column, parse_number_units, AccountEntry
+from rebalancer.utils import CORE
+
+DATA_DIR = path.join(path.dirname(path.abspath(__file__)), 'data')
+
+FIDELITY_ENTRIES = [
+    AccountEntry('X111', 'SPAXX', Decimal('1'), Decimal('1250.40'),
+                 'HELD IN MONEY MARKET', Decimal('1250.40')),
+    AccountEntry('X111', 'ITOT', Decimal('98.45'), Decimal('11814.00'),
+                 'ISHARES CORE S&P TOTAL', Decimal('120')),
+    # A quote inside an unquoted field is just a character
+    AccountEntry('X111', 'ABC', Decimal('1.00'), Decimal('1.00'),
+                 '12" SUB FUND', Decimal('1')),
+    AccountEntry('X111', CORE, Decimal('1'), Decimal('-250.00'),
+                 '', Decimal('-250.00')),
+    AccountEntry('Y222', 'FXAIX', Decimal('150.10'), Decimal('1576.05'),
+                 'FIDELITY 500 INDEX FUND', Decimal('10.5')),
+    AccountEntry('Y222', 'EX-US FUND, CLASS K', Decimal('20.00'), Decimal('60.00'),
+                 'EX-US FUND, CLASS K', Decimal('3')),
+]
+
+# Only the positions, not the transactions after the blank line
+VANGUARD_ENTRIES = [
+    AccountEntry('12345678', 'VTSAX', Decimal('110.25'), Decimal('11080.13'),
+                 'VANGUARD TOTAL STOCK MARKET INDEX ADMIRAL', Decimal('100.5')),
+    AccountEntry('12345678', 'VMFXX', Decimal('1'), Decimal('500'),
+                 'VANGUARD FEDERAL MONEY MARKET', Decimal('500')),
+]
+
+class ParseFileTest(unittest.TestCase):
+    def check_format(self, filename, expected):
+        filename = path.join(DATA_DIR, filename)
+
+        # Paths are read through mmap, file objects through the csv module
+        self.assertEqual(parse_file(filename), expected)
+        with open(filename, 'rb') as f:
+            self.assertEqual(parse_file(BytesIO(f.read())), expected)
+
+    def test_fidelity(self):
+        self.check_format('fidelity.csv', FIDELITY_ENTRIES)
+
+    def test_vanguard(self):
+        self.check_format('vanguard.csv', VANGUARD_ENTRIES)
+
+class ParseNumberTest(unittest.TestCase):
+    def test_units_match_decimal(self):
+        values = ('98.5 ', ' 98.5', '98.50\t', '-1.5', '+1.5', '(1.5)',
+                  ' ($1,234.5) ', '.5', '5.', '-.25', '0')
+        for val in values:
+            with self.subTest(val=val):
+                self.assertEqual(parse_number_units(val, 2),
+                                 parse_number_column(val) * 100)
+
+    def test_units_reject_malformed(self):
+        for val in ('', '1e3', 'abc', '1.2.3', '-', '.', '1.234', '--5', '1 2'):
+            with self.subTest(val=val):
+                self.assertRaises(ValueError, parse_number_units, val, 2)
+
+    def test_units_default(self):
+        self.assertEqual(parse_number_units('--', 2, 0), 0)
+
+if __name__ == '__main__':
+    unittest.main()